@@ -0,0 +1,6 @@
+import os
+
+# the bot config requires these, the benchmarks never talk to Discord so placeholders are enough
+for _name in ("PREFIX", "BOT_TOKEN", "CLIENT_ID", "CLIENT_SECRET"):
+    os.environ.setdefault(_name, "benchmark")
+os.environ.setdefault("REDIS_URI", "redis://localhost:6379/0")
@@ -0,0 +1,64 @@
+"""
+Benchmark for the payload encodings in getwvkeysbot.codec.
+
+Encodes and decodes a DISABLE_USER_BULK request with a range of id counts in every available
+format, reporting the encoded size and the time spent on each side.
+
+    python -m benchmarks.codec
+    python -m benchmarks.codec --ids 1000 50000 --rounds 50
+"""
+
+import argparse
+import random
+import time
+
+from benchmarks.rpc import CODECS
+from getwvkeysbot.codec import decode, msgpack
+from getwvkeysbot.redis import OPCode
+
+
+def build_payload(count: int) -> dict:
+    # snowflakes from the last few years, so the high bits look like the real thing
+    ids = sorted(random.randrange(700000000000000000, 1200000000000000000) for _ in range(count))
+    return {"op": OPCode.DISABLE_USER_BULK.value, "d": {"user_ids": ids}, "reply_to": "bot-benchmark:" + "0" * 32, "id": "0" * 32}
+
+
+def measure(codec, payload: dict, rounds: int):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        data = codec.encode(payload)
+    encode_time = (time.perf_counter() - start) / rounds
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decoded = decode(data)
+    decode_time = (time.perf_counter() - start) / rounds
+    if decoded["d"]["user_ids"] != payload["d"]["user_ids"]:
+        raise AssertionError("{} did not round trip".format(codec.name))
+    return len(data), encode_time, decode_time
+
+
+def main(args: argparse.Namespace) -> int:
+    random.seed(0)
+    print("{:>8} {:<22} {:>12} {:>8} {:>11} {:>11}".format("ids", "encoding", "bytes", "ratio", "encode ms", "decode ms"))
+    for count in args.ids:
+        payload = build_payload(count)
+        baseline = None
+        for name in CODECS:
+            if name == "msgpack" and msgpack is None:
+                continue
+            codec = CODECS[name]()
+            size, encode_time, decode_time = measure(codec, payload, args.rounds)
+            baseline = baseline or size
+            print("{:>8} {:<22} {:>12} {:>8.2f} {:>11.3f} {:>11.3f}".format(count, codec.name, size, size / baseline, encode_time * 1000, decode_time * 1000))
+    return 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ids", nargs="+", type=int, default=[10, 1000, 10000, 50000], help="ids per bulk request")
+    parser.add_argument("--rounds", type=int, default=20, help="encode and decode rounds per measurement")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(parse_args()))
@@ -0,0 +1,194 @@
+import asyncio
+import fnmatch
+import itertools
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from redis.exceptions import ResponseError
+
+
+class FakePubSub:
+    def __init__(self, server: "FakeRedis", ignore_subscribe_messages: bool = False):
+        self.server = server
+        self.channels: Set[str] = set()
+        self.patterns: Set[str] = set()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        server._pubsubs.append(self)
+
+    async def subscribe(self, *channels: str):
+        self.channels.update(channels)
+
+    async def psubscribe(self, *patterns: str):
+        self.patterns.update(patterns)
+
+    async def unsubscribe(self, *channels: str):
+        self.channels.difference_update(channels or set(self.channels))
+
+    async def punsubscribe(self, *patterns: str):
+        self.patterns.difference_update(patterns or set(self.patterns))
+
+    async def close(self):
+        if self in self.server._pubsubs:
+            self.server._pubsubs.remove(self)
+
+    async def listen(self):
+        while True:
+            yield await self._queue.get()
+
+    def _deliver(self, channel: str, data) -> int:
+        delivered = 0
+        if channel in self.channels:
+            self._queue.put_nowait({"type": "message", "pattern": None, "channel": channel, "data": data})
+            delivered += 1
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(channel, pattern):
+                self._queue.put_nowait({"type": "pmessage", "pattern": pattern, "channel": channel, "data": data})
+                delivered += 1
+        return delivered
+
+
+class FakeRedis:
+    """
+    In-process stand-in for the parts of redis.asyncio.Redis the bot uses, so benchmarks run offline.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        # simulated network round trip added to every command
+        self.latency = latency
+        self._pubsubs: List[FakePubSub] = []
+        self._data: Dict[str, object] = {}
+        self._expires: Dict[str, float] = {}
+        # stream name -> entries, and (stream, group) -> index of the next undelivered entry
+        self._streams: Dict[str, List[Tuple[str, dict]]] = {}
+        self._groups: Dict[Tuple[str, str], int] = {}
+        self._pending: Dict[Tuple[str, str], Set[str]] = {}
+        self._stream_ids = itertools.count(1)
+        self._stream_event = asyncio.Event()
+
+    async def _round_trip(self):
+        await asyncio.sleep(self.latency)
+
+    def pubsub(self, ignore_subscribe_messages: bool = False) -> FakePubSub:
+        return FakePubSub(self, ignore_subscribe_messages)
+
+    async def publish(self, channel: str, data) -> int:
+        await self._round_trip()
+        return sum(pubsub._deliver(channel, data) for pubsub in list(self._pubsubs))
+
+    async def ping(self) -> bool:
+        await self._round_trip()
+        return True
+
+    def _expire(self, key: str):
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+
+    async def get(self, key: str) -> Optional[object]:
+        await self._round_trip()
+        self._expire(key)
+        return self._data.get(key)
+
+    async def set(self, key: str, value, ex: Optional[float] = None, px: Optional[float] = None, nx: bool = False):
+        await self._round_trip()
+        self._expire(key)
+        if nx and key in self._data:
+            return None
+        self._data[key] = value
+        self._expires.pop(key, None)
+        if ex is not None:
+            self._expires[key] = time.monotonic() + ex
+        elif px is not None:
+            self._expires[key] = time.monotonic() + px / 1000
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        await self._round_trip()
+        return sum(self._data.pop(key, None) is not None for key in keys)
+
+    async def close(self):
+        pass
+
+    async def expire(self, key: str, seconds: float) -> bool:
+        await self._round_trip()
+        self._expires[key] = time.monotonic() + seconds
+        return True
+
+    async def xgroup_create(self, name: str, groupname: str, id: str = "$", mkstream: bool = False):
+        await self._round_trip()
+        if name not in self._streams:
+            if not mkstream:
+                raise ResponseError("ERR The XGROUP subcommand requires the key to exist")
+            self._streams[name] = []
+        if (name, groupname) in self._groups:
+            raise ResponseError("BUSYGROUP Consumer Group name already exists")
+        self._groups[(name, groupname)] = len(self._streams[name]) if id == "$" else 0
+        self._pending[(name, groupname)] = set()
+        return True
+
+    async def xadd(self, name: str, fields: dict, maxlen: Optional[int] = None, approximate: bool = True) -> str:
+        await self._round_trip()
+        entry_id = "{}-0".format(next(self._stream_ids))
+        self._streams.setdefault(name, []).append((entry_id, dict(fields)))
+        self._stream_event.set()
+        return entry_id
+
+    async def _wait_for_entries(self, block: Optional[int], ready):
+        deadline = time.monotonic() + (block or 0) / 1000
+        while True:
+            result = ready()
+            if result or block is None or time.monotonic() >= deadline:
+                return result
+            self._stream_event.clear()
+            try:
+                await asyncio.wait_for(self._stream_event.wait(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def xread(self, streams: dict, count: Optional[int] = None, block: Optional[int] = None):
+        await self._round_trip()
+
+        def ready():
+            result = []
+            for name, last_id in streams.items():
+                last = _parse_id(last_id)
+                entries = [entry for entry in self._streams.get(name, []) if _parse_id(entry[0]) > last][:count]
+                if entries:
+                    result.append([name, entries])
+            return result
+
+        return await self._wait_for_entries(block, ready)
+
+    async def xreadgroup(self, groupname: str, consumername: str, streams: dict, count: Optional[int] = None, block: Optional[int] = None):
+        await self._round_trip()
+
+        def ready():
+            result = []
+            for name in streams:
+                start = self._groups[(name, groupname)]
+                entries = self._streams.get(name, [])[start : start + count if count else None]
+                if entries:
+                    self._groups[(name, groupname)] = start + len(entries)
+                    self._pending[(name, groupname)].update(entry_id for entry_id, _ in entries)
+                    result.append([name, entries])
+            return result
+
+        return await self._wait_for_entries(block, ready)
+
+    async def xack(self, name: str, groupname: str, *ids: str) -> int:
+        await self._round_trip()
+        pending = self._pending.get((name, groupname), set())
+        acked = len(pending.intersection(ids))
+        pending.difference_update(ids)
+        return acked
+
+    async def xdel(self, name: str, *ids: str) -> int:
+        # entries stay in place so group offsets remain valid, the fake never runs long enough to matter
+        await self._round_trip()
+        return len(ids)
+
+
+def _parse_id(entry_id: str) -> Tuple[int, int]:
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
@@ -0,0 +1,182 @@
+"""
+Benchmark for the member cache modes.
+
+Builds a synthetic guild and loads its members the way each mode does at startup: the default
+mode turns every chunked member into a cached discord.Member, the lean mode (LEAN_MEMBER_CACHE)
+only indexes verified and admin ids. Then replays role updates through discord.py's gateway
+parser and checks both modes report the same verified role changes. Gateway and REST round trips
+are not simulated, only the work done in the bot process.
+
+    python -m benchmarks.members
+    python -m benchmarks.members --members 100000 250000 --verified 0.3
+"""
+
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from typing import List, Type
+
+import discord
+from discord.ext import commands
+
+from getwvkeysbot.config import ADMIN_ROLES, VERIFIED_ROLE
+from getwvkeysbot.members import MemberIndex
+
+GUILD_ID = 1
+OTHER_ROLES = [100 + i for i in range(20)]
+
+
+def user_payload(user_id: int, bot: bool = False) -> dict:
+    return {"id": str(user_id), "username": "user{}".format(user_id), "discriminator": "0", "global_name": None, "avatar": None, "bot": bot}
+
+
+def member_payload(user_id: int, roles: List[int], bot: bool = False) -> dict:
+    return {
+        "user": user_payload(user_id, bot),
+        "roles": [str(role_id) for role_id in roles],
+        "nick": None,
+        "avatar": None,
+        "joined_at": "2022-05-01T00:00:00+00:00",
+        "premium_since": None,
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+        "pending": False,
+    }
+
+
+def guild_payload(member_count: int) -> dict:
+    roles = [GUILD_ID, VERIFIED_ROLE, *ADMIN_ROLES, *OTHER_ROLES]
+    return {
+        "id": str(GUILD_ID),
+        "name": "benchmark",
+        "owner_id": "1",
+        "roles": [{"id": str(role_id), "name": str(role_id), "permissions": "0", "position": i, "color": 0, "hoist": False, "managed": False, "mentionable": False} for i, role_id in enumerate(roles)],
+        "emojis": [],
+        "stickers": [],
+        "features": [],
+        "channels": [],
+        "threads": [],
+        "members": [],
+        "member_count": member_count,
+        "large": True,
+    }
+
+
+def build_members(count: int, verified_ratio: float, rng: random.Random) -> List[dict]:
+    members = []
+    for i in range(count):
+        roles = rng.sample(OTHER_ROLES, rng.randint(0, 3))
+        if rng.random() < verified_ratio:
+            roles.append(VERIFIED_ROLE)
+        if i < 10:
+            roles.append(ADMIN_ROLES[0])
+        members.append(member_payload(900000000000000000 + i, roles, bot=rng.random() < 0.001))
+    return members
+
+
+def build_bot(lean: bool, bot_class: Type[commands.Bot] = commands.Bot) -> commands.Bot:
+    intents = discord.Intents.default()
+    intents.members = True
+    member_cache_flags = discord.MemberCacheFlags.none() if lean else discord.MemberCacheFlags.from_intents(intents)
+    bot = bot_class(command_prefix="!", intents=intents, member_cache_flags=member_cache_flags, chunk_guilds_at_startup=not lean)
+    bot._connection.parsers["GUILD_CREATE"](guild_payload(0))
+    return bot
+
+
+def load_members(bot: commands.Bot, index: MemberIndex, members: List[dict], lean: bool):
+    guild = bot.get_guild(GUILD_ID)
+    state = bot._connection
+    for data in members:
+        member = discord.Member(data=data, guild=guild, state=state)
+        if lean:
+            # what MemberIndex.load does with each member from guild.fetch_members
+            if not member.bot:
+                index.update(member.id, member._roles)
+        else:
+            guild._add_member(member)
+
+
+def replay_updates(bot: commands.Bot, members: List[dict], updates: int, rng: random.Random) -> int:
+    # toggles the verified role of random members and counts the changes the bot would act on
+    changes = 0
+
+    def dispatch(event, *args, **kwargs):
+        nonlocal changes
+        if event == "verified_update":
+            changes += 1
+        elif event == "member_update":
+            old, new = args
+            if not old.bot and (VERIFIED_ROLE in old._roles) != (VERIFIED_ROLE in new._roles):
+                changes += 1
+
+    # the member index dispatches through the bot, discord.py's parsers through the connection state
+    bot.dispatch = bot._connection.dispatch = dispatch
+    parser = bot._connection.parsers["GUILD_MEMBER_UPDATE"]
+    for _ in range(updates):
+        i = rng.randrange(len(members))
+        roles = [int(role_id) for role_id in members[i]["roles"]]
+        if VERIFIED_ROLE in roles:
+            roles.remove(VERIFIED_ROLE)
+        else:
+            roles.append(VERIFIED_ROLE)
+        members[i] = member_payload(int(members[i]["user"]["id"]), roles, bot=members[i]["user"]["bot"])
+        parser({**members[i], "guild_id": str(GUILD_ID)})
+    return changes
+
+
+def run_mode(members: List[dict], lean: bool, updates: int, seed: int) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    bot = build_bot(lean)
+    index = MemberIndex(guild_id=GUILD_ID)
+    if lean:
+        index.install(bot)
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    load_members(bot, index, members, lean)
+    load_time = time.perf_counter() - start
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    changes = replay_updates(bot, list(members), updates, random.Random(seed))
+    return {
+        "mode": "lean" if lean else "full",
+        "members": len(members),
+        "cached": len(bot.get_guild(GUILD_ID).members),
+        "indexed": len(index.verified) + len(index.admins),
+        "load": load_time,
+        "memory": memory,
+        "changes": changes,
+    }
+
+
+def main(args: argparse.Namespace) -> int:
+    print("{:>9} {:<6} {:>9} {:>9} {:>10} {:>11} {:>9}".format("members", "mode", "cached", "indexed", "load s", "memory MiB", "changes"))
+    failed = False
+    for count in args.members:
+        members = build_members(count, args.verified, random.Random(args.seed))
+        results = [run_mode(members, lean, args.updates, args.seed) for lean in (False, True)]
+        for result in results:
+            print("{members:>9} {mode:<6} {cached:>9} {indexed:>9} {load:>10.2f} {memory:>11.1f} {changes:>9}".format(**{**result, "memory": result["memory"] / 1024 / 1024}))
+        if results[0]["changes"] != results[1]["changes"]:
+            print("FAIL: the modes saw a different number of verified role changes")
+            failed = True
+    return 1 if failed else 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", nargs="+", type=int, default=[10000, 100000], help="guild sizes to load")
+    parser.add_argument("--verified", type=float, default=0.2, help="share of members holding the verified role")
+    parser.add_argument("--updates", type=int, default=1000, help="role updates to replay")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(parse_args()))
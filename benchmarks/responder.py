@@ -0,0 +1,100 @@
+import asyncio
+import random
+from collections import Counter
+from typing import List, Optional
+
+from redis.exceptions import ResponseError
+
+from getwvkeysbot.codec import decode, frame_codec
+from getwvkeysbot.config import API_STREAM_GROUP
+from getwvkeysbot.redis import OPCode
+
+
+def build_reply(op: int, data: dict):
+    # every reply echoes the request data so callers can detect crossed replies
+    if op in (OPCode.KEY_COUNT.value, OPCode.USER_COUNT.value):
+        return {"count": 123456, "echo": data}
+    if op == OPCode.SEARCH.value and "kids" in data:
+        # batched search, one result per kid
+        return {"results": {kid: {"kid": kid, "keys": [{"key": "{}:{:032x}".format(kid, i)} for i in range(3)], "total": 3} for kid in data["kids"]}, "echo": data}
+    if op == OPCode.SEARCH.value:
+        keys = [{"key": "{:032x}:{:032x}".format(i, i)} for i in range(data.get("limit") or 10)]
+        return {"kid": "0" * 32, "keys": keys, "total": 1000, "echo": data}
+    return {"message": "ok", "echo": data}
+
+
+class StandInResponder:
+    """
+    Local stand-in for the API. Speaks the same ``{"op", "d", "reply_to"}`` protocol over pub/sub, and
+    over the request stream when ``request_stream`` is given, and answers every request after a
+    simulated service time. Replies are encoded in the same format as the request.
+    """
+
+    def __init__(self, redis_cli, request_channel: str = "api", service_time: float = 0.0, jitter: float = 0.0, request_stream: Optional[str] = None):
+        self.redis = redis_cli
+        self.request_channel = request_channel
+        self.request_stream = request_stream
+        self.service_time = service_time
+        self.jitter = jitter
+        self.handled = 0
+        # how often each (op, user id) was requested, to spot users that were sent more than once
+        self.user_ops: Counter = Counter()
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(self.request_channel)
+        self._tasks.append(asyncio.create_task(self._listen(pubsub)))
+        if self.request_stream:
+            try:
+                await self.redis.xgroup_create(self.request_stream, API_STREAM_GROUP, id="$", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+            self._tasks.append(asyncio.create_task(self._consume_stream()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    async def _consume_stream(self):
+        consumer = "responder-{}".format(id(self))
+        while True:
+            result = await self.redis.xreadgroup(API_STREAM_GROUP, consumer, {self.request_stream: ">"}, count=500, block=1000)
+            for _, entries in result or []:
+                for entry_id, fields in entries:
+                    asyncio.create_task(self._reply_stream(entry_id, fields["payload"]))
+
+    async def _reply_stream(self, entry_id: str, data):
+        request = decode(data)
+        self._record(request)
+        await self._simulate_work()
+        reply = {"op": OPCode.REPLY.value, "d": {"message": build_reply(request["op"], request["d"])}}
+        await self.redis.xadd(request["reply_to"], {"id": entry_id, "payload": frame_codec(data).encode(reply)})
+        await self.redis.xack(self.request_stream, API_STREAM_GROUP, entry_id)
+
+    async def _listen(self, pubsub):
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+            asyncio.create_task(self._reply(message["data"]))
+
+    def _record(self, request: dict):
+        data = request["d"] or {}
+        user_ids = data.get("user_ids") or ([data["user_id"]] if "user_id" in data else [])
+        for user_id in user_ids:
+            self.user_ops[(request["op"], user_id)] += 1
+
+    async def _simulate_work(self):
+        delay = self.service_time + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        self.handled += 1
+
+    async def _reply(self, data):
+        request = decode(data)
+        self._record(request)
+        await self._simulate_work()
+        reply = {"op": OPCode.REPLY.value, "d": {"message": build_reply(request["op"], request["d"])}}
+        await self.redis.publish(request["reply_to"], frame_codec(data).encode(reply))
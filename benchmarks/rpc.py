@@ -0,0 +1,147 @@
+"""
+Benchmark for the Redis request/reply path in getwvkeysbot.redis.
+
+Runs a local stand-in API responder and sweeps concurrency levels for each OPCode, reporting
+latency percentiles, throughput and any replies that were delivered to the wrong caller.
+
+    python -m benchmarks.rpc                               # in-process fake redis, fully offline
+    python -m benchmarks.rpc --redis-uri redis://localhost:6379/0
+    python -m benchmarks.rpc --transport streams          # moderation ops through the request stream
+    python -m benchmarks.rpc --codec msgpack              # framed msgpack payloads with packed ids
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+from typing import List
+
+from benchmarks.fakeredis import FakeRedis
+from benchmarks.responder import StandInResponder
+from getwvkeysbot.codec import CODEC_JSON, CODEC_MSGPACK, FRAME_VERSION, PayloadCodec
+from getwvkeysbot.redis import MODERATION_OPS, APIClient, OPCode
+
+DEFAULT_OPS = ["KEY_COUNT", "SEARCH", "DISABLE_USER", "DISABLE_USER_BULK"]
+CODECS = {
+    "legacy": lambda: PayloadCodec(),
+    "json": lambda: PayloadCodec(version=FRAME_VERSION, codec=CODEC_JSON, compress=True, pack_ids=True),
+    "msgpack": lambda: PayloadCodec(version=FRAME_VERSION, codec=CODEC_MSGPACK, compress=True, pack_ids=True),
+}
+
+
+def build_request(op: OPCode, nonce: str) -> dict:
+    if op == OPCode.SEARCH:
+        return {"query": "0" * 32, "offset": 0, "limit": 10, "nonce": nonce}
+    if op == OPCode.DISABLE_USER_BULK:
+        return {"user_ids": list(range(1000)), "nonce": nonce}
+    if op in (OPCode.DISABLE_USER, OPCode.ENABLE_USER, OPCode.RESET_API_KEY):
+        return {"user_id": 970332150891155607, "nonce": nonce}
+    return {"nonce": nonce}
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def run_level(client: APIClient, op: OPCode, concurrency: int, requests: int) -> dict:
+    latencies: List[float] = []
+    crossed = 0
+    failed = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal crossed, failed
+        for _ in remaining:
+            nonce = uuid.uuid4().hex
+            start = time.perf_counter()
+            try:
+                reply = await client.request(op, build_request(op, nonce))
+            except Exception:
+                failed += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            if reply["echo"].get("nonce") != nonce:
+                crossed += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {
+        "op": op.name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "failed": failed,
+        "crossed": crossed,
+        "rps": len(latencies) / elapsed if elapsed else 0,
+        "mean": statistics.mean(latencies) if latencies else 0,
+        "p50": percentile(latencies, 0.5) if latencies else 0,
+        "p95": percentile(latencies, 0.95) if latencies else 0,
+        "p99": percentile(latencies, 0.99) if latencies else 0,
+    }
+
+
+def print_result(result: dict):
+    print(
+        "{op:<18} {concurrency:>6} {requests:>8} {failed:>6} {crossed:>7} {rps:>10.0f} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f}".format(
+            **{**result, "p50": result["p50"] * 1000, "p95": result["p95"] * 1000, "p99": result["p99"] * 1000}
+        )
+    )
+
+
+async def main(args: argparse.Namespace) -> int:
+    if args.redis_uri:
+        import redis.asyncio as aioredis
+
+        redis_cli = aioredis.Redis.from_url(args.redis_uri)
+        channel = "api-benchmark-{}".format(uuid.uuid4().hex[:8])
+    else:
+        redis_cli = FakeRedis(latency=args.redis_latency / 1000)
+        channel = "api"
+    stream = channel + "-stream" if args.transport == "streams" else None
+
+    responder = StandInResponder(redis_cli, channel, service_time=args.service_time / 1000, jitter=args.jitter / 1000, request_stream=stream)
+    await responder.start()
+    stream_ops = MODERATION_OPS if stream else frozenset()
+    client = APIClient(redis_cli, request_channel=channel, stream_ops=stream_ops, request_stream=stream or channel, codec=CODECS[args.codec]())
+    await client.start()
+    print("payload encoding: {}".format(client.codec.name))
+
+    print("{:<18} {:>6} {:>8} {:>6} {:>7} {:>10} {:>9} {:>9} {:>9}".format("op", "conc", "ok", "failed", "crossed", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    crossed = 0
+    try:
+        for op_name in args.ops:
+            op = OPCode[op_name]
+            for concurrency in args.concurrency:
+                result = await run_level(client, op, concurrency, max(args.requests, concurrency))
+                crossed += result["crossed"]
+                print_result(result)
+    finally:
+        await client.close()
+        await responder.stop()
+        await redis_cli.close()
+
+    if crossed:
+        print("FAIL: {} replies were delivered to the wrong caller".format(crossed))
+        return 1
+    return 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-uri", help="benchmark against a real redis instead of the in-process fake")
+    parser.add_argument("--ops", nargs="+", default=DEFAULT_OPS, choices=[op.name for op in OPCode], help="OPCodes to benchmark")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 10, 100, 500], help="concurrency levels to sweep")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per concurrency level")
+    parser.add_argument("--service-time", type=float, default=1.0, help="simulated API processing time in ms")
+    parser.add_argument("--jitter", type=float, default=1.0, help="random extra API processing time in ms")
+    parser.add_argument("--transport", choices=["pubsub", "streams"], default="pubsub", help="transport for moderation ops")
+    parser.add_argument("--codec", choices=sorted(CODECS), default="legacy", help="payload encoding")
+    parser.add_argument("--redis-latency", type=float, default=0.0, help="simulated redis round trip in ms (fake redis only)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(main(parse_args())))
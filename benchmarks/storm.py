@@ -0,0 +1,351 @@
+"""
+Load test for the member event path.
+
+Builds a synthetic guild and replays a storm of gateway events (bans, leaves and verified role
+flips) through discord.py's parsers into the real MemberEvents handlers, the outbox, the request
+coalescer, the audit log and the DM queue. The API is a stand-in responder on an in-process Redis,
+the Discord REST calls made by the audit log and the DM queue go to a local stand-in that only
+counts them. Reports handler and end-to-end latency (event received to outbox entry applied),
+peak queue depths, API and REST calls, log output and peak memory for the default and the lean
+member cache.
+
+    python -m benchmarks.storm
+    python -m benchmarks.storm --bans 5000 --leaves 0 --flips 0 --verified 1   # raid ban
+    python -m benchmarks.storm --outbox-rate 1000 --rate 2000 --modes lean
+"""
+
+import argparse
+import asyncio
+import gc
+import logging
+import pathlib
+import random
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import discord
+from discord.ext import commands
+
+import getwvkeysbot.redis
+from benchmarks.fakeredis import FakeRedis
+from benchmarks.members import GUILD_ID, build_bot, build_members, load_members, member_payload
+from benchmarks.responder import StandInResponder
+from benchmarks.rpc import CODECS, percentile
+from getwvkeysbot.audit import AuditLog
+from getwvkeysbot.coalescer import coalescer
+from getwvkeysbot.cogs.events import MemberEvents
+from getwvkeysbot.config import DM_RATE, OUTBOX_RATE
+from getwvkeysbot.dm import DMQueue
+from getwvkeysbot.members import MemberIndex
+from getwvkeysbot.metrics import metrics
+from getwvkeysbot.outbox import Outbox
+from getwvkeysbot.redis import APIClient
+from getwvkeysbot.settings import settings
+
+# (gateway event, payload, user id)
+Event = Tuple[str, dict, int]
+
+
+class StandInChannel:
+    def __init__(self, rest: "StandInREST", channel_id: int):
+        self.rest = rest
+        self.id = channel_id
+        self.messages: List[str] = []
+
+    async def send(self, content: Optional[str] = None, **kwargs):
+        await self.rest.call("send_message")
+        self.messages.append(content or "")
+
+
+class StandInREST:
+    """
+    Takes the place of the bot for the components that call Discord's REST API. Every call is
+    counted and answered after ``latency`` seconds.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Dict[str, int] = Counter()
+        self.channels: Dict[int, StandInChannel] = {}
+
+    async def call(self, route: str):
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def get_channel(self, channel_id: int) -> Optional[StandInChannel]:
+        return self.channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id: int) -> StandInChannel:
+        await self.call("get_channel")
+        return self.channels.setdefault(channel_id, StandInChannel(self, channel_id))
+
+    async def create_dm(self, user: discord.abc.Snowflake) -> StandInChannel:
+        await self.call("create_dm")
+        return StandInChannel(self, user.id)
+
+
+class StormBot(commands.Bot):
+    # times every dispatched event handler from the moment it is scheduled until it returns
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handler_latency: Dict[str, List[float]] = defaultdict(list)
+        self.handlers_running = 0
+
+    def _schedule_event(self, coro, event_name: str, *args, **kwargs) -> asyncio.Task:
+        scheduled = time.perf_counter()
+        self.handlers_running += 1
+
+        async def timed(*args, **kwargs):
+            try:
+                await coro(*args, **kwargs)
+            finally:
+                self.handlers_running -= 1
+                self.handler_latency[event_name].append(time.perf_counter() - scheduled)
+
+        return super()._schedule_event(timed, event_name, *args, **kwargs)
+
+
+class TimedOutbox(Outbox):
+    # records the time from the first event about a user to each of their entries being applied
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received: Dict[int, float] = {}
+        self.latencies: List[float] = []
+        self.submitted = 0
+
+    def submit(self, action, data: dict, audit: Optional[str] = None, failure: Optional[str] = None) -> int:
+        entry_id = super().submit(action, data, audit, failure)
+        self.submitted += 1
+        received = self.received.get(data.get("user_id"))
+        if received is not None:
+            self.wait(entry_id).add_done_callback(lambda future: self._applied(future, received))
+        return entry_id
+
+    def _applied(self, future: asyncio.Future, received: float):
+        if not future.cancelled() and future.exception() is None:
+            self.latencies.append(time.perf_counter() - received)
+
+
+class LogCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.records: Dict[str, int] = Counter()
+
+    def emit(self, record: logging.LogRecord):
+        self.records[record.levelname] += 1
+
+
+def build_storm(members: List[dict], bans: int, leaves: int, flips: int, rng: random.Random) -> List[List[Event]]:
+    # every member is hit at most once, a ban is followed by the member leaving like on discord
+    targets = rng.sample(range(len(members)), min(len(members), bans + leaves + flips))
+    storm = []
+    for n, i in enumerate(targets):
+        data = members[i]
+        user_id = int(data["user"]["id"])
+        if n < bans:
+            storm.append(
+                [
+                    ("GUILD_BAN_ADD", {"guild_id": str(GUILD_ID), "user": data["user"]}, user_id),
+                    ("GUILD_MEMBER_REMOVE", {"guild_id": str(GUILD_ID), "user": data["user"]}, user_id),
+                ]
+            )
+        elif n < bans + leaves:
+            storm.append([("GUILD_MEMBER_REMOVE", {"guild_id": str(GUILD_ID), "user": data["user"]}, user_id)])
+        else:
+            roles = [int(role_id) for role_id in data["roles"]]
+            if settings.verified_role in roles:
+                roles.remove(settings.verified_role)
+            else:
+                roles.append(settings.verified_role)
+            storm.append([("GUILD_MEMBER_UPDATE", {**member_payload(user_id, roles, bot=data["user"]["bot"]), "guild_id": str(GUILD_ID)}, user_id)])
+    rng.shuffle(storm)
+    return [event for group in storm for event in group]
+
+
+async def run_mode(members: List[dict], storm: List[Event], lean: bool, args: argparse.Namespace) -> dict:
+    redis_cli = FakeRedis(latency=args.redis_latency / 1000)
+    responder = StandInResponder(redis_cli, service_time=args.service_time / 1000)
+    await responder.start()
+    client = APIClient(redis_cli, codec=CODECS[args.codec]())
+    await client.start()
+    # the outbox and the coalescer send through the module level client
+    getwvkeysbot.redis.api = client
+
+    rest = StandInREST(args.rest_latency / 1000)
+    audit = AuditLog(rest)
+    workdir = tempfile.TemporaryDirectory()
+    outbox = TimedOutbox(audit, path=pathlib.Path(workdir.name, "outbox.sqlite3"), rate=args.outbox_rate)
+    dm_queue = DMQueue(rest, rate=args.dm_rate, redis_cli=redis_cli)
+
+    bot = build_bot(lean, bot_class=StormBot)
+    index = MemberIndex(guild_id=GUILD_ID, redis_cli=redis_cli)
+    if lean:
+        index.install(bot)
+    load_members(bot, index, members, lean)
+    await bot.add_cog(MemberEvents(outbox, dm_queue, member_index=index, lean=lean, guild_id=GUILD_ID))
+
+    counter = LogCounter()
+    package_logger = logging.getLogger("getwvkeysbot")
+    package_logger.setLevel(logging.INFO)
+    package_logger.propagate = False
+    package_logger.addHandler(counter)
+    requests_before = dict(metrics.requests)
+    depth: Dict[str, int] = Counter()
+
+    async def sample():
+        while True:
+            for name, value in (
+                ("handlers", bot.handlers_running),
+                ("outbox", outbox.pending()),
+                ("coalescer", len(coalescer._intents)),
+                ("audit lines", len(audit._queue)),
+                ("DMs", sum(dm_queue.backlog().values())),
+            ):
+                depth[name] = max(depth[name], value)
+            await asyncio.sleep(args.sample_interval / 1000)
+
+    gc.collect()
+    if args.memory:
+        tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0] if args.memory else 0
+
+    async with bot:
+        outbox.start()
+        dm_queue.start()
+        await audit.resolve_channels()
+        sampler = asyncio.create_task(sample())
+        parsers = bot._connection.parsers
+        start = time.perf_counter()
+        for n, (event, data, user_id) in enumerate(storm):
+            outbox.received.setdefault(user_id, time.perf_counter())
+            parsers[event](data)
+            if args.rate:
+                # keep the pace of the storm, whatever the handlers cost
+                await asyncio.sleep(max(0.0, start + (n + 1) / args.rate - time.perf_counter()))
+            else:
+                # the gateway reads one message at a time, so handlers get to run in between
+                await asyncio.sleep(0)
+        injected = time.perf_counter() - start
+
+        deadline = time.monotonic() + args.timeout
+        while (bot.handlers_running or outbox.pending()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        drained = time.perf_counter() - start
+        timed_out = bool(bot.handlers_running or outbox.pending())
+        while audit._queue and time.monotonic() < deadline:
+            await audit.flush()
+        sampler.cancel()
+
+        peak = tracemalloc.get_traced_memory()[1] - baseline if args.memory else None
+        if args.memory:
+            tracemalloc.stop()
+        for task in (outbox._drainer, dm_queue._worker, audit._flusher):
+            task.cancel()
+
+    package_logger.removeHandler(counter)
+    await client.close()
+    await responder.stop()
+    outbox.db.close()
+    workdir.cleanup()
+
+    log_channel = rest.channels.get(settings.log_channel_id)
+    return {
+        "mode": "lean" if lean else "full",
+        "events": len(storm),
+        "injected": injected,
+        "drained": drained,
+        "timed_out": timed_out,
+        "entries": outbox.submitted,
+        "handlers": {name: latencies for name, latencies in bot.handler_latency.items() if name.startswith("on_")},
+        "end_to_end": outbox.latencies,
+        "depth": depth,
+        "api": {op: count - requests_before.get(op, 0) for op, count in metrics.requests.items() if count > requests_before.get(op, 0)},
+        "responder": responder.handled,
+        "repeated_users": sum(1 for count in responder.user_ops.values() if count > 1),
+        "rest": dict(rest.calls),
+        "audit_messages": len(log_channel.messages) if log_channel else 0,
+        "audit_lines": sum(message.count("\n") + 1 for message in log_channel.messages) if log_channel else 0,
+        "dm_sent": dm_queue.sent,
+        "dm_backlog": sum(dm_queue.backlog().values()),
+        "log_records": dict(counter.records),
+        "peak": peak,
+    }
+
+
+def format_latencies(samples: List[float], scale: float, unit: str) -> str:
+    if not samples:
+        return "n/a"
+    return "p50 {:.2f}{unit} p95 {:.2f}{unit} p99 {:.2f}{unit} max {:.2f}{unit}".format(
+        percentile(samples, 0.5) * scale, percentile(samples, 0.95) * scale, percentile(samples, 0.99) * scale, max(samples) * scale, unit=unit
+    )
+
+
+def print_result(result: dict):
+    print(
+        "{mode}: {events} events replayed in {injected:.2f}s, {entries} outbox entries, drained after {drained:.2f}s{timeout}".format(**result, timeout=" (TIMED OUT)" if result["timed_out"] else "")
+    )
+    for name, samples in sorted(result["handlers"].items()):
+        print("  {:<24} {:>6}  {}".format(name, len(samples), format_latencies(samples, 1000, "ms")))
+    print("  {:<24} {:>6}  {}".format("end to end", len(result["end_to_end"]), format_latencies(result["end_to_end"], 1, "s")))
+    print("  peak queue depth         {}".format(", ".join("{} {}".format(name, value) for name, value in result["depth"].items())))
+    print("  API calls                {} (responder handled {})".format(", ".join("{} {}".format(op, count) for op, count in sorted(result["api"].items())) or "none", result["responder"]))
+    print("  users sent twice         {}".format(result["repeated_users"]))
+    print("  Discord REST calls       {}".format(", ".join("{} {}".format(route, count) for route, count in sorted(result["rest"].items())) or "none"))
+    print("  audit log                {} lines in {} messages".format(result["audit_lines"], result["audit_messages"]))
+    print("  DMs                      {} sent, {} still queued".format(result["dm_sent"], result["dm_backlog"]))
+    print("  log records              {}".format(", ".join("{} {}".format(level, count) for level, count in sorted(result["log_records"].items())) or "none"))
+    if result["peak"] is not None:
+        print("  peak memory              {:.1f} MiB".format(result["peak"] / 1024 / 1024))
+
+
+async def main(args: argparse.Namespace) -> int:
+    rng = random.Random(args.seed)
+    members = build_members(args.members, args.verified, rng)
+    storm = build_storm(members, args.bans, args.leaves, args.flips, rng)
+    print("{} members, {} bans, {} leaves, {} role flips, {} gateway events".format(args.members, args.bans, args.leaves, args.flips, len(storm)))
+
+    results = []
+    for mode in args.modes:
+        result = await run_mode(members, storm, mode == "lean", args)
+        print_result(result)
+        results.append(result)
+
+    failed = any(result["timed_out"] for result in results)
+    if any(result["repeated_users"] for result in results):
+        # every member is hit once by the storm, a ban and its member_remove must be sent as one disable
+        print("FAIL: some users were sent to the API more than once")
+        failed = True
+    if len({result["entries"] for result in results}) > 1:
+        print("FAIL: the modes submitted a different number of outbox entries")
+        failed = True
+    return 1 if failed else 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=20000, help="members in the synthetic guild")
+    parser.add_argument("--verified", type=float, default=0.2, help="share of members holding the verified role")
+    parser.add_argument("--bans", type=int, default=500, help="members banned during the storm")
+    parser.add_argument("--leaves", type=int, default=200, help="members leaving during the storm")
+    parser.add_argument("--flips", type=int, default=500, help="members gaining or losing the verified role during the storm")
+    parser.add_argument("--rate", type=float, default=0, help="gateway events per second, 0 replays the storm as one burst")
+    parser.add_argument("--modes", nargs="+", choices=["full", "lean"], default=["full", "lean"], help="member cache modes to run")
+    parser.add_argument("--outbox-rate", type=float, default=OUTBOX_RATE, help="outbox entries sent per second")
+    parser.add_argument("--dm-rate", type=float, default=DM_RATE, help="DMs sent per second")
+    parser.add_argument("--service-time", type=float, default=1.0, help="simulated API processing time in ms")
+    parser.add_argument("--redis-latency", type=float, default=0.0, help="simulated redis round trip in ms")
+    parser.add_argument("--rest-latency", type=float, default=50.0, help="simulated Discord REST round trip in ms")
+    parser.add_argument("--codec", choices=sorted(CODECS), default="legacy", help="payload encoding")
+    parser.add_argument("--sample-interval", type=float, default=10.0, help="queue depth sampling interval in ms")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds to wait for the outbox to drain")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip tracemalloc, which slows the run down")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(main(parse_args())))
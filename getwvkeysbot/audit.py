@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+import discord
+
+from getwvkeysbot.config import AUDIT_CLOSE_TIMEOUT, AUDIT_FLUSH_INTERVAL, AUDIT_MAX_MESSAGES_PER_FLUSH, AUDIT_MAX_SEND_ATTEMPTS, AUDIT_QUEUE_SIZE
+from getwvkeysbot.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# discord rejects message contents longer than this
+MESSAGE_LIMIT = 2000
+
+
+class AuditLog:
+    """
+    Batched writer for the log channel.
+
+    Entries are queued and packed into as few messages as possible every flush interval, sending at
+    most ``max_messages`` messages per flush to stay inside the channel rate limit. Urgent entries
+    (error pings) skip the queue. Channel handles are resolved once and cached.
+
+    The queue holds at most ``max_queue`` lines and a message that failed ``max_attempts`` times is
+    given up on, both count the lines in ``dropped`` so an unreachable channel can't grow the queue
+    without bound.
+    """
+
+    def __init__(
+        self,
+        bot: discord.Client,
+        flush_interval: float = AUDIT_FLUSH_INTERVAL,
+        max_messages: int = AUDIT_MAX_MESSAGES_PER_FLUSH,
+        max_queue: int = AUDIT_QUEUE_SIZE,
+        max_attempts: int = AUDIT_MAX_SEND_ATTEMPTS,
+    ):
+        self.bot = bot
+        self.flush_interval = flush_interval
+        self.max_messages = max_messages
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.dropped = 0
+        self._attempts = 0
+        self._channels: Dict[int, discord.abc.Messageable] = {}
+        self._queue: List[str] = []
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def resolve_channels(self):
+        # called from on_ready so the handles are refreshed after reconnects
+        for channel_id in (settings.log_channel_id, settings.interrogation_channel_id):
+            self._channels.pop(channel_id, None)
+            try:
+                await self.get_channel(channel_id)
+            except discord.HTTPException as e:
+                logger.exception("[Discord] Failed to resolve channel {}".format(channel_id), exc_info=e)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def get_channel(self, channel_id: int) -> discord.abc.Messageable:
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+            self._channels[channel_id] = channel
+        return channel
+
+    def log(self, content: str):
+        if len(self._queue) >= self.max_queue:
+            if not self.dropped:
+                logger.warning("[Discord] The audit log queue is full, dropping new entries")
+            self.dropped += 1
+            return
+        self._queue.append(content[:MESSAGE_LIMIT])
+
+    async def urgent(self, content: str):
+        channel = await self.get_channel(settings.log_channel_id)
+        await channel.send(content[:MESSAGE_LIMIT])
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception("[Discord] Failed to flush the audit log", exc_info=e)
+
+    async def flush(self):
+        if not self._queue:
+            return
+        channel = await self.get_channel(settings.log_channel_id)
+        for _ in range(self.max_messages):
+            if not self._queue:
+                break
+            # pack as many queued lines as fit into one message
+            count = 0
+            length = 0
+            for line in self._queue:
+                if count and length + len(line) + 1 > MESSAGE_LIMIT:
+                    break
+                count += 1
+                length += len(line) + 1
+            message = "\n".join(self._queue[:count])
+            try:
+                await channel.send(message)
+            except Exception:
+                # keep the lines so a failed send is retried on the next flush, up to max_attempts times
+                self._attempts += 1
+                if self._attempts < self.max_attempts:
+                    raise
+                logger.error("[Discord] Giving up on {} audit log lines after {} failed attempts".format(count, self._attempts))
+                self.dropped += count
+            self._attempts = 0
+            del self._queue[:count]
+
+    async def close(self, timeout: float = AUDIT_CLOSE_TIMEOUT):
+        # send what is still queued before shutting down, for at most ``timeout`` seconds
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+
+        async def drain():
+            while self._queue:
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.exception("[Discord] Failed to flush the audit log", exc_info=e)
+                    await asyncio.sleep(1)
+
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("[Discord] {} audit log lines were not sent before shutdown".format(len(self._queue)))
@@ -0,0 +1,52 @@
+from typing import Union
+
+import discord
+from discord.ext import commands
+
+from getwvkeysbot.audit import AuditLog
+from getwvkeysbot.config import BOT_PREFIX, LEAN_MEMBER_CACHE, SHARD_COUNT, SHARD_IDS, SHARDED
+from getwvkeysbot.dm import DMQueue
+from getwvkeysbot.members import member_index
+from getwvkeysbot.metrics import metrics
+from getwvkeysbot.outbox import Outbox
+from getwvkeysbot.settings import settings
+
+# extensions loaded at startup, each can be reloaded in place with the reload command
+EXTENSIONS = [
+    "getwvkeysbot.cogs.events",
+    "getwvkeysbot.cogs.general",
+    "getwvkeysbot.cogs.admin",
+    "getwvkeysbot.cogs.owner",
+]
+
+# the bot and the state shared by the extensions live here, so reloading an extension keeps them
+intents = discord.Intents.default()
+intents.message_content = True
+intents.members = True
+# the lean mode still needs the member events, but keeps no member objects around
+member_cache_flags = discord.MemberCacheFlags.none() if LEAN_MEMBER_CACHE else discord.MemberCacheFlags.from_intents(intents)
+if SHARDED:
+    bot = commands.AutoShardedBot(
+        command_prefix=BOT_PREFIX,
+        intents=intents,
+        member_cache_flags=member_cache_flags,
+        chunk_guilds_at_startup=not LEAN_MEMBER_CACHE,
+        shard_count=SHARD_COUNT,
+        shard_ids=SHARD_IDS,
+    )
+else:
+    bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents, member_cache_flags=member_cache_flags, chunk_guilds_at_startup=not LEAN_MEMBER_CACHE)
+audit = AuditLog(bot)
+outbox = Outbox(audit)
+dm_queue = DMQueue(bot)
+metrics.register_gauge("getwvkeysbot_outbox_pending", "Outbox entries waiting to be sent", lambda: {"pending": outbox.pending()})
+metrics.register_gauge("getwvkeysbot_dm_backlog", "Direct messages waiting to be delivered", dm_queue.backlog)
+metrics.register_gauge("getwvkeysbot_audit_log", "Audit log lines waiting to be sent and dropped since start", lambda: {"queued": len(audit._queue), "dropped": audit.dropped})
+metrics.register_gauge("getwvkeysbot_dm_delivery", "Direct messages sent, retried and dead-lettered since start", lambda: {"sent": dm_queue.sent, "retried": dm_queue.retried, "dead": dm_queue.dead})
+
+
+def is_admin(user: Union[discord.User, discord.Member]) -> bool:
+    # members carry their roles, outside the guild fall back to the member index
+    if isinstance(user, discord.Member):
+        return settings.is_admin(user.id, user._roles)
+    return settings.is_admin(user.id) or member_index.is_admin(user.id)
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import re
+import time
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Set
+
+import aiohttp
+import discord
+
+from getwvkeysbot.config import BULK_CONCURRENCY, BULK_PROGRESS_INTERVAL
+from getwvkeysbot.redis import APIQueued
+
+logger = logging.getLogger(__name__)
+
+# any 17 to 20 digit number in an uploaded file is taken as a user id, so plain lists, csv exports
+# and pasted mentions all work
+SNOWFLAKE_RE = re.compile(rb"(?<![0-9])[0-9]{17,20}(?![0-9])")
+
+
+async def read_user_ids(attachment: discord.Attachment, chunk_size: int = 64 * 1024) -> AsyncIterator[int]:
+    # streams the attachment instead of loading it into memory, duplicates are skipped
+    seen: Set[int] = set()
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+            tail = b""
+            async for data in response.content.iter_chunked(chunk_size):
+                data = tail + data
+                # a number cut off at the end of this chunk is completed by the next one
+                cut = len(data)
+                while cut and data[cut - 1 : cut].isdigit():
+                    cut -= 1
+                tail = data[cut:]
+                for user_id in _parse_ids(data[:cut], seen):
+                    yield user_id
+            for user_id in _parse_ids(tail, seen):
+                yield user_id
+
+
+def _parse_ids(data: bytes, seen: Set[int]) -> List[int]:
+    ids = []
+    for match in SNOWFLAKE_RE.finditer(data):
+        user_id = int(match.group())
+        if user_id < 2**64 and user_id not in seen:
+            seen.add(user_id)
+            ids.append(user_id)
+    return ids
+
+
+class BulkResult:
+    def __init__(self):
+        self.done = 0
+        self.queued = 0
+        self.failed: List[int] = []
+        self.errors: List[str] = []
+
+    @property
+    def total(self) -> int:
+        return self.done + self.queued + len(self.failed)
+
+    def summary(self) -> str:
+        return "{} done, {} queued, {} failed".format(self.done, self.queued, len(self.failed))
+
+
+async def run_bulk(
+    user_ids: AsyncIterator[int],
+    send: Callable[[List[int]], Awaitable[object]],
+    chunk_size: int,
+    concurrency: int = BULK_CONCURRENCY,
+    progress: Optional[Callable[[BulkResult], Awaitable[None]]] = None,
+    progress_interval: float = BULK_PROGRESS_INTERVAL,
+) -> BulkResult:
+    """
+    Sends ``user_ids`` in chunks of ``chunk_size`` through ``send``, with at most ``concurrency``
+    chunks in flight. Ids are pulled from the iterator only as chunks are sent, so a large file
+    is never held in memory at once. ``progress`` is awaited at most every ``progress_interval``
+    seconds and once at the end.
+    """
+    result = BulkResult()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks: Set[asyncio.Task] = set()
+    last_progress = time.monotonic()
+
+    async def send_chunk(chunk: List[int]):
+        try:
+            await send(chunk)
+            result.done += len(chunk)
+        except APIQueued:
+            # stored in the outbox, it will be applied once the backend catches up
+            result.queued += len(chunk)
+        except Exception as e:
+            logger.warning("[Bulk] Failed to process {} users: {}".format(len(chunk), e))
+            result.failed.extend(chunk)
+            if len(result.errors) < 5 and str(e) not in result.errors:
+                result.errors.append(str(e))
+        finally:
+            semaphore.release()
+
+    async def report():
+        nonlocal last_progress
+        if progress is not None and time.monotonic() - last_progress >= progress_interval:
+            last_progress = time.monotonic()
+            try:
+                await progress(result)
+            except Exception as e:
+                logger.warning("[Bulk] Failed to report progress: {}".format(e))
+
+    async def submit(chunk: List[int]):
+        await semaphore.acquire()
+        task = asyncio.create_task(send_chunk(chunk))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        await report()
+
+    chunk: List[int] = []
+    try:
+        async for user_id in user_ids:
+            chunk.append(user_id)
+            if len(chunk) >= chunk_size:
+                await submit(chunk)
+                chunk = []
+        if chunk:
+            await submit(chunk)
+        while tasks:
+            await asyncio.wait(set(tasks), timeout=progress_interval)
+            await report()
+    finally:
+        for task in tasks:
+            task.cancel()
+    if progress is not None:
+        await progress(result)
+    return result
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from getwvkeysbot.config import (
+    COUNT_CACHE_REFRESH_AHEAD,
+    COUNT_CACHE_TTL,
+    SEARCH_CACHE_INVALIDATION_CHANNEL,
+    SEARCH_CACHE_NEGATIVE_TTL,
+    SEARCH_CACHE_SIZE,
+    SEARCH_CACHE_TTL,
+)
+from getwvkeysbot.pssh import normalize_search_query
+from getwvkeysbot.redis import OPCode, api, make_api_request
+
+logger = logging.getLogger(__name__)
+
+SearchKey = Tuple[str, int, Optional[int]]
+
+
+class CountCache:
+    """
+    TTL cache for argument-less API requests such as KEY_COUNT and USER_COUNT.
+
+    Concurrent callers share a single in-flight request, and entries that are about to expire are
+    refreshed in the background so warm callers never wait on the API.
+    """
+
+    def __init__(self, ttl: float = COUNT_CACHE_TTL, refresh_ahead: float = COUNT_CACHE_REFRESH_AHEAD):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        # op -> (value, expires at)
+        self._entries: Dict[OPCode, Tuple[Any, float]] = {}
+        self._inflight: Dict[OPCode, asyncio.Future] = {}
+
+    async def get(self, action: OPCode):
+        entry = self._entries.get(action)
+        now = time.monotonic()
+        if entry is not None and entry[1] > now:
+            if entry[1] - now < self.refresh_ahead:
+                self._fetch(action)
+            return entry[0]
+        # shield so a cancelled caller doesn't cancel the request shared with everyone else
+        return await asyncio.shield(self._fetch(action))
+
+    def invalidate(self, action: Optional[OPCode] = None):
+        if action is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(action, None)
+
+    def _fetch(self, action: OPCode) -> asyncio.Future:
+        future = self._inflight.get(action)
+        if future is None:
+            future = asyncio.ensure_future(self._refresh(action))
+            self._inflight[action] = future
+            future.add_done_callback(lambda f: _discard_inflight(self._inflight, action, f))
+        return future
+
+    async def _refresh(self, action: OPCode):
+        value = await make_api_request(action)
+        self._entries[action] = (value, time.monotonic() + self.ttl)
+        return value
+
+
+class SearchCache:
+    """
+    Bounded LRU cache with TTL for SEARCH result pages, keyed by the normalized query and page.
+
+    Empty results are cached for a shorter time. Entries are dropped when the API publishes a KID on
+    the invalidation channel, either because the query was that KID or because the result was for it.
+    """
+
+    def __init__(self, max_size: int = SEARCH_CACHE_SIZE, ttl: float = SEARCH_CACHE_TTL, negative_ttl: float = SEARCH_CACHE_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # (normalized query, offset, limit) -> (result, expires at)
+        self._entries: "OrderedDict[SearchKey, Tuple[Any, float]]" = OrderedDict()
+        # normalized query or result kid -> cache keys
+        self._index: Dict[str, Set[SearchKey]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _get(self, key: SearchKey):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    async def search(self, query: str, offset: int = 0, limit: Optional[int] = None):
+        key = (normalize_search_query(query), offset, limit)
+        entry = self._get(key)
+        if entry is not None:
+            return entry[0]
+        data = {"query": query}
+        if offset or limit is not None:
+            data.update({"offset": offset, "limit": limit})
+        results = await make_api_request(OPCode.SEARCH, data)
+        self._store(key, results)
+        return results
+
+    async def search_many(self, kids: List[str]) -> Dict[str, Any]:
+        # full results for several normalized kids, only the ones that aren't cached are requested
+        results = {}
+        missing = []
+        for kid in kids:
+            entry = self._get((kid, 0, None))
+            if entry is not None:
+                results[kid] = entry[0]
+            else:
+                missing.append(kid)
+        if not missing:
+            return results
+
+        if len(missing) > 1 and api.capabilities.get("batch_search"):
+            # one request for every kid, answered with {"results": {kid: result}}
+            reply = await make_api_request(OPCode.SEARCH, {"kids": missing})
+            batch = {normalize_search_query(kid): result for kid, result in ((reply or {}).get("results") or {}).items()}
+            for kid in missing:
+                # a kid the reply left out is unknown rather than known to have no keys, so it isn't cached
+                if kid in batch:
+                    self._store((kid, 0, None), batch[kid])
+                results[kid] = batch.get(kid)
+            return results
+        fetched = await asyncio.gather(*[make_api_request(OPCode.SEARCH, {"query": kid}) for kid in missing])
+        for kid, result in zip(missing, fetched):
+            self._store((kid, 0, None), result)
+            results[kid] = result
+        return results
+
+    def _store(self, key: SearchKey, results):
+        self._discard(key)
+        negative = not results or len(results.get("keys") or []) == 0
+        self._entries[key] = (results, time.monotonic() + (self.negative_ttl if negative else self.ttl))
+        for name in self._index_names(key, results):
+            self._index.setdefault(name, set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _discard(self, key: SearchKey):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for name in self._index_names(key, entry[0]):
+            keys = self._index.get(name)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[name]
+
+    @staticmethod
+    def _index_names(key: SearchKey, results):
+        yield key[0]
+        kid = normalize_search_query(results["kid"]) if results and results.get("kid") else None
+        if kid and kid != key[0]:
+            yield kid
+
+    def invalidate(self, kid: str):
+        for key in list(self._index.get(normalize_search_query(kid), ())):
+            self._discard(key)
+            self.invalidations += 1
+
+    def handle_invalidation(self, data: str):
+        # the API publishes either a bare kid, {"kid": ...} or {"kids": [...]}
+        try:
+            message = json.loads(data)
+            kids = message.get("kids") or [message["kid"]]
+        except (ValueError, AttributeError, KeyError):
+            kids = [data]
+        for kid in kids:
+            self.invalidate(kid)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+def _discard_inflight(inflight: Dict[OPCode, asyncio.Future], action: OPCode, future: asyncio.Future):
+    inflight.pop(action, None)
+    # background refreshes have no caller to report to, so log their failures here
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("[Cache] Failed to refresh {}: {}".format(action.name, future.exception()))
+
+
+count_cache = CountCache()
+
+search_cache = SearchCache()
+
+
+async def subscribe_invalidations():
+    await api.subscribe(SEARCH_CACHE_INVALIDATION_CHANNEL, search_cache.handle_invalidation)
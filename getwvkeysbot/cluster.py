@@ -0,0 +1,175 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Callable, List, Optional
+
+from getwvkeysbot.config import CLUSTER_NODE_ID, CLUSTER_NODE_TTL, CLUSTER_SIZE, GUILD_ID, SHARD_COUNT, SHARD_IDS
+from getwvkeysbot.redis import redis_cli
+
+logger = logging.getLogger(__name__)
+
+# only touch a key while this node still owns it
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class LockNotAcquired(Exception):
+    pass
+
+
+class Cluster:
+    """
+    Coordinates bot processes through Redis.
+
+    Each process claims one of ``size`` slots and runs the shards whose id modulo ``size`` equals its
+    slot. One process at a time holds the leader key and runs singleton tasks, only processes running
+    the shard of the main guild take part since the singleton tasks need its members. Keys expire
+    after ``ttl`` seconds unless renewed, so a crashed process frees its slot and leadership on its
+    own. A process whose slot expired takes it back if it is still free, otherwise the slot listeners
+    are told so the process can stop the shards it no longer owns.
+    """
+
+    def __init__(
+        self,
+        redis_cli=redis_cli,
+        node_id: str = CLUSTER_NODE_ID,
+        size: int = CLUSTER_SIZE,
+        ttl: int = CLUSTER_NODE_TTL,
+        guild_id: int = GUILD_ID,
+        shard_count: Optional[int] = SHARD_COUNT,
+        fixed_shard_ids: Optional[List[int]] = SHARD_IDS,
+    ):
+        self.redis = redis_cli
+        self.node_id = node_id
+        self.size = size
+        self.ttl = ttl
+        self.guild_id = guild_id
+        self.shard_count = shard_count
+        self.fixed_shard_ids = fixed_shard_ids
+        self.slot: Optional[int] = None
+        self.is_leader = False
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._slot_listeners: List[Callable[[], None]] = []
+        self._leader_listeners: List[Callable[[], None]] = []
+
+    async def start(self):
+        if self._heartbeat is not None:
+            return
+        if self.size > 1:
+            await self._claim_slot()
+        else:
+            self.slot = 0
+        await self._elect()
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def close(self):
+        # hand the slot and leadership over right away, a restarted process would otherwise wait out the ttl
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        if self.is_leader:
+            await self.redis.eval(RELEASE_SCRIPT, 1, "cluster:leader", self.node_id)
+            self.is_leader = False
+        if self.size > 1 and self.slot is not None:
+            await self.redis.eval(RELEASE_SCRIPT, 1, "cluster:slot:{}".format(self.slot), self.node_id)
+
+    def shard_ids(self, shard_count: int) -> List[int]:
+        return [shard_id for shard_id in range(shard_count) if shard_id % self.size == self.slot]
+
+    def runs_guild(self) -> bool:
+        # whether this process runs the shard that receives the main guild's events
+        if self.shard_count is None:
+            return True
+        shard_id = (self.guild_id >> 22) % self.shard_count
+        if self.fixed_shard_ids is not None:
+            return shard_id in self.fixed_shard_ids
+        return self.size <= 1 or shard_id % self.size == self.slot
+
+    def add_slot_listener(self, listener: Callable[[], None]):
+        # called when another node took over this node's slot
+        self._slot_listeners.append(listener)
+
+    def add_leader_listener(self, listener: Callable[[], None]):
+        # called when this node becomes the leader
+        self._leader_listeners.append(listener)
+
+    def _notify(self, listeners: List[Callable[[], None]]):
+        for listener in listeners:
+            try:
+                listener()
+            except Exception as e:
+                logger.exception("[Cluster] Listener failed", exc_info=e)
+
+    async def _claim_slot(self):
+        while True:
+            for slot in range(self.size):
+                if await self.redis.set("cluster:slot:{}".format(slot), self.node_id, nx=True, ex=self.ttl):
+                    self.slot = slot
+                    logger.info("[Cluster] Node {} claimed slot {}/{}".format(self.node_id, slot, self.size))
+                    return
+            logger.warning("[Cluster] All {} slots are taken, waiting for one to free up".format(self.size))
+            await asyncio.sleep(self.ttl / 3)
+
+    async def _renew(self, key: str) -> bool:
+        return bool(await self.redis.eval(RENEW_SCRIPT, 1, key, self.node_id, self.ttl))
+
+    async def _elect(self):
+        if not self.runs_guild():
+            self.is_leader = False
+            return
+        if self.is_leader:
+            self.is_leader = await self._renew("cluster:leader")
+        else:
+            self.is_leader = bool(await self.redis.set("cluster:leader", self.node_id, nx=True, ex=self.ttl))
+            if self.is_leader:
+                logger.info("[Cluster] Node {} is now the leader".format(self.node_id))
+                self._notify(self._leader_listeners)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if self.size > 1 and not await self._renew("cluster:slot:{}".format(self.slot)):
+                    if not await self._reclaim_slot():
+                        return
+                await self._elect()
+            except Exception as e:
+                self.is_leader = False
+                logger.exception("[Cluster] Heartbeat failed", exc_info=e)
+
+    async def _reclaim_slot(self) -> bool:
+        key = "cluster:slot:{}".format(self.slot)
+        # the slot expired, e.g. after redis was unreachable for a while, take it back unless another node has
+        if await self.redis.set(key, self.node_id, nx=True, ex=self.ttl):
+            logger.warning("[Cluster] Node {} reclaimed slot {}".format(self.node_id, self.slot))
+            return True
+        logger.error("[Cluster] Node {} lost slot {} to {}, stopping its shards".format(self.node_id, self.slot, await self.redis.get(key)))
+        if self.is_leader:
+            await self.redis.eval(RELEASE_SCRIPT, 1, "cluster:leader", self.node_id)
+            self.is_leader = False
+        self._notify(self._slot_listeners)
+        return False
+
+    @asynccontextmanager
+    async def lock(self, name: str, ttl: int = 3600):
+        # cluster wide mutex, raises LockNotAcquired if another process holds it
+        key = "cluster:lock:{}".format(name)
+        if not await self.redis.set(key, self.node_id, nx=True, ex=ttl):
+            raise LockNotAcquired(name)
+        try:
+            yield
+        finally:
+            await self.redis.eval(RELEASE_SCRIPT, 1, key, self.node_id)
+
+
+cluster = Cluster()
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Set, Tuple
+
+from getwvkeysbot.config import COALESCE_MAX_BATCH, COALESCE_WINDOW
+from getwvkeysbot.redis import OPCode, make_api_request
+
+logger = logging.getLogger(__name__)
+
+
+class IntentSuperseded(Exception):
+    """
+    Raised to callers whose intent was replaced by the opposite intent for the same user before it
+    was sent, their change was never applied.
+    """
+
+    def __init__(self, user_id: int, enabled: bool):
+        super().__init__("The {} of user {} was superseded by a later {}".format("enable" if enabled else "disable", user_id, "disable" if enabled else "enable"))
+        self.user_id = user_id
+        self.enabled = enabled
+
+
+class UserStateCoalescer:
+    """
+    Collects enable/disable intents for a short window and flushes them together.
+
+    Intents are deduplicated per user and the latest intent wins, callers of a replaced intent get
+    IntentSuperseded. All disables in a window are sent as a single DISABLE_USER_BULK request, and
+    every caller waiting on a user gets that user's result.
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW, max_batch: int = COALESCE_MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        # user id -> (enabled, future shared by every caller for that user)
+        self._intents: Dict[int, Tuple[bool, asyncio.Future]] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flushes: Set[asyncio.Task] = set()
+
+    async def disable(self, user_id: int):
+        # shield the shared future so one cancelled caller doesn't cancel it for everyone else
+        return await asyncio.shield(self._submit(user_id, False))
+
+    async def enable(self, user_id: int):
+        return await asyncio.shield(self._submit(user_id, True))
+
+    def _submit(self, user_id: int, enabled: bool) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        intent = self._intents.get(user_id)
+        if intent is not None and intent[0] == enabled:
+            # same intent is already queued for this user, share its result
+            return intent[1]
+
+        if intent is not None and not intent[1].done():
+            # the newer intent replaces the older one, which is never sent
+            intent[1].set_exception(IntentSuperseded(user_id, intent[0]))
+        future = loop.create_future()
+        self._intents[user_id] = (enabled, future)
+
+        if len(self._intents) >= self.max_batch:
+            self._flush_now()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush_now)
+        return future
+
+    def _flush_now(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        intents, self._intents = self._intents, {}
+        if intents:
+            # keep a reference, the loop only holds weak references to tasks
+            task = asyncio.create_task(self._flush(intents))
+            self._flushes.add(task)
+            task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task: asyncio.Task):
+        self._flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.exception("[Coalescer] Flush failed", exc_info=task.exception())
+
+    async def _flush(self, intents: Dict[int, Tuple[bool, asyncio.Future]]):
+        disables = {user_id: future for user_id, (enabled, future) in intents.items() if not enabled}
+        enables = {user_id: future for user_id, (enabled, future) in intents.items() if enabled}
+        logger.debug("[Coalescer] Flushing {} disables and {} enables".format(len(disables), len(enables)))
+
+        tasks = []
+        if disables:
+            tasks.append(self._send(OPCode.DISABLE_USER_BULK, {"user_ids": list(disables)}, disables.values()))
+        # there is no bulk op for enabling users, send them concurrently instead
+        for user_id, future in enables.items():
+            tasks.append(self._send(OPCode.ENABLE_USER, {"user_id": user_id}, [future]))
+        await asyncio.gather(*tasks)
+
+    @staticmethod
+    async def _send(action: OPCode, data: dict, futures):
+        try:
+            result = await make_api_request(action, data)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future in futures:
+                if not future.done():
+                    future.set_result(result)
+
+
+coalescer = UserStateCoalescer()
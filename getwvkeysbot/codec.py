@@ -0,0 +1,187 @@
+import base64
+import json
+import struct
+import zlib
+from typing import Optional, Tuple, Union
+
+from getwvkeysbot.config import PAYLOAD_COMPRESSION_THRESHOLD, PAYLOAD_PACK_MIN_IDS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# framed payloads start with FRAME_MAGIC, a version byte, a codec byte and a flags byte,
+# anything else is a plain JSON payload from before the format was negotiated
+FRAME_MAGIC = b"GW"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<2sBBB")
+
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+CODEC_NAMES = {CODEC_JSON: "json", CODEC_MSGPACK: "msgpack"}
+
+FLAG_ZLIB = 1
+
+# packed id lists, a msgpack ext type or {"$u64": base64} in JSON, holding little-endian uint64s
+U64_EXT_TYPE = 1
+U64_JSON_KEY = "$u64"
+
+
+def _dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def _loads(data: Union[str, bytes]):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _pack_u64(ids: list) -> Optional[bytes]:
+    try:
+        return struct.pack("<{}Q".format(len(ids)), *ids)
+    except struct.error:
+        # not all unsigned 64 bit integers, send the list as is
+        return None
+
+
+def _unpack_u64(data: bytes) -> list:
+    return list(struct.unpack("<{}Q".format(len(data) // 8), data))
+
+
+class PayloadCodec:
+    """
+    Encodes API payloads in the format negotiated with the API.
+
+    Version 0 is the plain JSON the API has always accepted. Version 1 frames the payload with a
+    small header naming the codec (JSON or msgpack) and whether the body is zlib compressed. Long
+    integer lists in ``d``, like the user ids of bulk ops, are sent as packed uint64 arrays. Packed
+    ids barely compress, so they don't count towards the compression threshold.
+    """
+
+    def __init__(
+        self,
+        version: int = 0,
+        codec: int = CODEC_JSON,
+        compress: bool = False,
+        pack_ids: bool = False,
+        compression_threshold: int = PAYLOAD_COMPRESSION_THRESHOLD,
+        pack_min_ids: int = PAYLOAD_PACK_MIN_IDS,
+    ):
+        if codec == CODEC_MSGPACK and msgpack is None:
+            raise ValueError("msgpack is not installed")
+        self.version = version
+        self.codec = codec
+        self.compress = compress
+        self.pack_ids = pack_ids
+        self.compression_threshold = compression_threshold
+        self.pack_min_ids = pack_min_ids
+
+    @classmethod
+    def negotiate(cls, capabilities: Optional[dict]) -> "PayloadCodec":
+        # capabilities are advertised by the API as {"version", "codecs", "compression", "packed_ids"}
+        if not capabilities or capabilities.get("version", 0) < FRAME_VERSION:
+            return cls()
+        codecs = capabilities.get("codecs") or []
+        codec = CODEC_MSGPACK if "msgpack" in codecs and msgpack is not None else CODEC_JSON
+        if codec == CODEC_JSON and "json" not in codecs:
+            return cls()
+        return cls(
+            version=FRAME_VERSION,
+            codec=codec,
+            compress="zlib" in (capabilities.get("compression") or []),
+            pack_ids=bool(capabilities.get("packed_ids")),
+        )
+
+    @property
+    def name(self) -> str:
+        if self.version == 0:
+            return "json (legacy)"
+        return "{}{}{}".format(CODEC_NAMES[self.codec], "+zlib" if self.compress else "", "+u64" if self.pack_ids else "")
+
+    def encode(self, payload: dict) -> bytes:
+        if self.version == 0:
+            return _dumps(payload)
+
+        packed_size = 0
+        if self.pack_ids and isinstance(payload.get("d"), dict):
+            d = {}
+            for key, value in payload["d"].items():
+                d[key], size = self._pack_value(value)
+                packed_size += size
+            payload = {**payload, "d": d}
+        if self.codec == CODEC_MSGPACK:
+            body = msgpack.packb(payload, use_bin_type=True)
+        else:
+            body = _dumps(payload)
+
+        flags = 0
+        if self.compress and len(body) - packed_size >= self.compression_threshold:
+            compressed = zlib.compress(body, 1)
+            if len(compressed) < len(body):
+                body = compressed
+                flags |= FLAG_ZLIB
+        return FRAME_HEADER.pack(FRAME_MAGIC, self.version, self.codec, flags) + body
+
+    def _pack_value(self, value) -> Tuple[object, int]:
+        # returns the value to send and how many bytes of it are packed ids
+        if not isinstance(value, list) or len(value) < self.pack_min_ids:
+            return value, 0
+        packed = _pack_u64(value)
+        if packed is None:
+            return value, 0
+        if self.codec == CODEC_MSGPACK:
+            return msgpack.ExtType(U64_EXT_TYPE, packed), len(packed)
+        encoded = base64.b64encode(packed).decode()
+        return {U64_JSON_KEY: encoded}, len(encoded)
+
+
+def _msgpack_ext_hook(code: int, data: bytes):
+    if code == U64_EXT_TYPE:
+        return _unpack_u64(data)
+    return msgpack.ExtType(code, data)
+
+
+def _unpack_json_ids(payload):
+    d = payload.get("d") if isinstance(payload, dict) else None
+    if isinstance(d, dict):
+        for key, value in d.items():
+            if isinstance(value, dict) and len(value) == 1 and U64_JSON_KEY in value:
+                d[key] = _unpack_u64(base64.b64decode(value[U64_JSON_KEY]))
+    return payload
+
+
+def decode(data: Union[str, bytes]):
+    # accepts both framed and plain JSON payloads, whichever format the sender used
+    if isinstance(data, str) or data[:2] != FRAME_MAGIC:
+        return _loads(data)
+
+    _, version, codec, flags = FRAME_HEADER.unpack_from(data)
+    if version > FRAME_VERSION:
+        raise ValueError("Unsupported payload version {}".format(version))
+    body = data[FRAME_HEADER.size :]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    if codec == CODEC_MSGPACK:
+        if msgpack is None:
+            raise ValueError("Received a msgpack payload but msgpack is not installed")
+        return msgpack.unpackb(body, raw=False, ext_hook=_msgpack_ext_hook, strict_map_key=False)
+    if codec == CODEC_JSON:
+        return _unpack_json_ids(_loads(body))
+    raise ValueError("Unsupported payload codec {}".format(codec))
+
+
+def frame_codec(data: Union[str, bytes]) -> PayloadCodec:
+    # the codec a payload was encoded with, so a reply can be sent back in the same format
+    if isinstance(data, str) or data[:2] != FRAME_MAGIC:
+        return PayloadCodec()
+    _, version, codec, _ = FRAME_HEADER.unpack_from(data)
+    return PayloadCodec(version=version, codec=codec, compress=True, pack_ids=True)
@@ -0,0 +1,363 @@
+import asyncio
+import io
+import logging
+from typing import List, Optional
+
+import discord
+from discord.ext import commands
+
+from getwvkeysbot.bot import audit, dm_queue, is_admin, outbox
+from getwvkeysbot.bulk import read_user_ids, run_bulk
+from getwvkeysbot.cache import search_cache
+from getwvkeysbot.cluster import LockNotAcquired, cluster
+from getwvkeysbot.config import BULK_CONCURRENCY, OUTBOX_BATCH_SIZE, SYNC_CHECKPOINT_TTL, SYNC_CHUNK_SIZE
+from getwvkeysbot.metrics import metrics
+from getwvkeysbot.redis import APIQueued, OPCode, api, make_api_request, redis_cli
+from getwvkeysbot.settings import settings
+from getwvkeysbot.utils import FlagAction, UserFlags, dropped_log_records, parse_flags
+
+logger = logging.getLogger(__name__)
+
+
+def _format_seconds(value: Optional[float]) -> str:
+    return "n/a" if value is None else "{}ms".format(round(value * 1000, 1))
+
+
+async def sync_guild_bans(ctx: commands.Context, restart: bool):
+    checkpoint_key = "sync:{}:checkpoint".format(ctx.guild.id)
+    if restart:
+        await redis_cli.delete(checkpoint_key)
+    checkpoint = await redis_cli.get(checkpoint_key)
+
+    if checkpoint:
+        m = await ctx.reply("Resuming the previous sync after user `{}`. This might take a while, please be patient.".format(checkpoint))
+    else:
+        m = await ctx.reply("Syncing the banned users with the database might take a while. Please be patient.")
+
+    synced = 0
+
+    async def send_chunk(user_ids: List[int]):
+        nonlocal synced
+        await make_api_request(OPCode.DISABLE_USER_BULK, {"user_ids": user_ids})
+        synced += len(user_ids)
+        # bans are fetched in ascending user id order, so the last id of a synced chunk is a safe resume point
+        await redis_cli.set(checkpoint_key, user_ids[-1], ex=SYNC_CHECKPOINT_TTL)
+        await m.edit(content="Syncing guild bans... {} synced so far.".format(synced))
+
+    # stream the bans page by page, sending each chunk while the next page is being fetched
+    pending: Optional[asyncio.Task] = None
+    chunk = []
+    try:
+        after = discord.Object(id=int(checkpoint)) if checkpoint else discord.utils.MISSING
+        async for entry in ctx.guild.bans(limit=None, after=after):
+            chunk.append(entry.user.id)
+            if len(chunk) >= SYNC_CHUNK_SIZE:
+                if pending is not None:
+                    await pending
+                pending = asyncio.create_task(send_chunk(chunk))
+                chunk = []
+        if pending is not None:
+            await pending
+        if chunk:
+            await send_chunk(chunk)
+        await redis_cli.delete(checkpoint_key)
+        await m.reply("{} guild bans have been synced with the database.".format(synced))
+    except Exception as e:
+        if pending is not None and not pending.done():
+            pending.cancel()
+        logger.exception(e)
+        # the sync can be resumed from the checkpoint straight away, don't make the admin wait out the cooldown
+        ctx.command.reset_cooldown(ctx)
+        await m.reply(content="An error occurred while syncing the guild bans after {} were synced: {}. Run the command again to resume.".format(synced, e))
+
+
+async def run_bulk_command(ctx: commands.Context, file: discord.Attachment, description: str, send, chunk_size: int, concurrency: int):
+    m = await ctx.reply("{}: reading user ids from `{}`...".format(description, file.filename))
+
+    async def progress(result):
+        await m.edit(content="{}: {} users processed ({}).".format(description, result.total, result.summary()))
+
+    try:
+        result = await run_bulk(read_user_ids(file), send, chunk_size, concurrency=concurrency, progress=progress)
+    except Exception as e:
+        logger.exception("[Bulk] {} from {} failed".format(description, file.filename), exc_info=e)
+        return await m.reply("An error occurred while processing `{}`: {}".format(file.filename, e))
+
+    if result.total == 0:
+        return await m.edit(content="No user ids were found in `{}`.".format(file.filename))
+
+    # one audit entry for the whole file instead of one per user
+    audit.log("{} by {}#{} (`{}`) from `{}`: {} users, {}.".format(description, ctx.author.name, ctx.author.discriminator, ctx.author.id, file.filename, result.total, result.summary()))
+    content = "{} finished: {} users, {}.".format(description, result.total, result.summary())
+    if result.queued:
+        content += " Queued changes will be applied once the backend catches up."
+    if result.errors:
+        content += "\nErrors: {}".format("; ".join(result.errors))
+    files = []
+    if result.failed:
+        files.append(discord.File(io.BytesIO("\n".join(map(str, result.failed)).encode()), filename="failed.txt"))
+    await m.reply(content[:2000], files=files)
+
+
+def send_per_user(action: OPCode, build_data):
+    # ops without a bulk OPCode go through the outbox one user at a time
+    async def send(chunk: List[int]):
+        for user_id in chunk:
+            await outbox.submit_and_wait(action, build_data(user_id))
+
+    return send
+
+
+class Admin(commands.Cog):
+    """Moderation and diagnostics commands, only usable by admins."""
+
+    @commands.hybrid_command(hidden=True, help="Show request and event statistics")
+    async def stats(self, ctx: commands.Context):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+
+        lines = ["**API requests** (breaker {})".format(api.breaker.state)]
+        for op, histogram in sorted(metrics.request_latency.items()):
+            lines.append(
+                "`{}`: {} sent, {} failed, {} in flight, p50 {}, p95 {}, p99 {}".format(
+                    op,
+                    metrics.requests[op],
+                    metrics.request_errors[op],
+                    metrics.inflight[op],
+                    _format_seconds(histogram.quantile(0.5)),
+                    _format_seconds(histogram.quantile(0.95)),
+                    _format_seconds(histogram.quantile(0.99)),
+                )
+            )
+        lines.append("**Gateway events** ({} in the last minute)".format(metrics.events_per_minute()))
+        for event, histogram in sorted(metrics.event_latency.items()):
+            lines.append("`{}`: {} handled, {} failed, p95 {}".format(event, metrics.events[event], metrics.event_errors[event], _format_seconds(histogram.quantile(0.95))))
+        lines.append("Outbox backlog: {}".format(outbox.pending()))
+        dm_stats = dm_queue.stats()
+        lines.append(
+            "DM backlog: {high} high, {normal} normal, {low} low, {retrying} retrying. {sent} sent ({per_minute} in the last minute), {retried} retried, {dead} dead-lettered".format(**dm_stats)
+        )
+        lines.append("Node `{}`, slot {}, {}".format(cluster.node_id, cluster.slot, "leader" if cluster.is_leader else "follower"))
+        lines.append("Dropped log records: {}".format(dropped_log_records()))
+        lines.append("Startup: {}".format(", ".join("{} {:.2f}s".format(phase, seconds) for phase, seconds in metrics.startup.items()) or "n/a"))
+        await ctx.reply("\n".join(lines)[:2000])
+
+    @commands.hybrid_command(hidden=True, help="Show direct messages that could not be delivered")
+    async def dmfailures(self, ctx: commands.Context, limit: int = 10):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+        entries = await dm_queue.dead_letters(min(max(limit, 1), 50))
+        if not entries:
+            return await ctx.reply("No undelivered direct messages.")
+        lines = ["<t:{}:R> `{}`: {} after {} attempts".format(int(entry["failed_at"]), entry["user_id"], entry["reason"], entry["attempts"]) for entry in entries]
+        await ctx.reply("\n".join(lines)[:2000])
+
+    @commands.hybrid_command(hidden=True, help="Sync the guild bans with the database. This will disable users that are banned from the guild.")
+    @commands.cooldown(1, 3600, commands.BucketType.guild)
+    async def sync(self, ctx: commands.Context, restart: bool = False):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+
+        # bans are synced by one process at a time across the cluster
+        try:
+            async with cluster.lock("sync:{}".format(ctx.guild.id)):
+                await sync_guild_bans(ctx, restart)
+        except LockNotAcquired:
+            await ctx.reply("A sync for this server is already running.")
+
+    @commands.hybrid_command(hidden=True, help="Show search cache statistics")
+    async def cachestats(self, ctx: commands.Context):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+        stats = search_cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / lookups * 100 if lookups else 0
+        await ctx.reply(
+            "Search cache: {}/{} entries, {} hits, {} misses ({:.1f}% hit rate), {} evictions, {} invalidations".format(
+                stats["size"], stats["max_size"], stats["hits"], stats["misses"], hit_rate, stats["evictions"], stats["invalidations"]
+            )
+        )
+
+    @commands.hybrid_command(hidden=True, help="Suspends a user with an optional reason and rules broken")
+    async def suspend_user(self, ctx: commands.Context, member: discord.Member, reason: str = None, rules_broken: str = None):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+        try:
+            # unverify the user
+            await member.remove_roles(ctx.guild.get_role(settings.verified_role))
+            await member.add_roles(ctx.guild.get_role(settings.sus_role))
+
+            if reason:
+                # send a message to the interrogation channel
+                interrogation_channel = await audit.get_channel(settings.interrogation_channel_id)
+                if rules_broken:
+                    message = "{}, Your access has been suspended for the following reason: **Rule(s) {} - {}**".format(member.mention, rules_broken, reason)
+                else:
+                    message = "{}, Your access has been suspended for the following reason: **{}**".format(member.mention, reason)
+
+                await interrogation_channel.send(message)
+
+                await ctx.reply("{} has been suspended".format(member.mention))
+        except Exception as e:
+            logger.exception("[Discord]", exc_info=e)
+            await ctx.reply("An error occurred while suspending user: {}".format(e))
+
+    @commands.hybrid_command(hidden=True, help="Disable a user account")
+    async def disable_user(self, ctx: commands.Context, user: discord.User):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+        try:
+            await outbox.submit_and_wait(
+                OPCode.DISABLE_USER,
+                {"user_id": user.id},
+                audit="User {}#{} (`{}`) was disabled by {}#{} (`{}`)".format(user.name, user.discriminator, user.id, ctx.author.name, ctx.author.discriminator, ctx.author.id),
+            )
+            await ctx.reply("User {}#{} (`{}`) was disabled.".format(user.name, user.discriminator, user.id))
+        except APIQueued:
+            await ctx.reply("The backend is busy, the change for {}#{} (`{}`) was queued and will be applied once it catches up.".format(user.name, user.discriminator, user.id))
+        except Exception as e:
+            logger.exception("[Discord]", exc_info=e)
+            await ctx.reply("An error occurred while disabling user: {}".format(e))
+
+    @commands.hybrid_command(hidden=True, help="Enable a user account")
+    async def enable_user(self, ctx: commands.Context, user: discord.User):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+        try:
+            await outbox.submit_and_wait(
+                OPCode.ENABLE_USER,
+                {"user_id": user.id},
+                audit="User {}#{} (`{}`) was enabled by {}#{} (`{}`)".format(user.name, user.discriminator, user.id, ctx.author.name, ctx.author.discriminator, ctx.author.id),
+            )
+            await ctx.reply("User {}#{} (`{}`) was enabled.".format(user.name, user.discriminator, user.id))
+        except APIQueued:
+            await ctx.reply("The backend is busy, the change for {}#{} (`{}`) was queued and will be applied once it catches up.".format(user.name, user.discriminator, user.id))
+        except Exception as e:
+            logger.exception("[Discord]", exc_info=e)
+            await ctx.reply("An error occurred while enabling user: {}".format(e))
+
+    @commands.hybrid_command(hidden=True, help="Reset a users API Key")
+    # TODO: limit this to 2 times per day
+    async def reset_api_key(self, ctx: commands.Context, user: discord.User):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+        try:
+            await outbox.submit_and_wait(
+                OPCode.RESET_API_KEY,
+                {"user_id": user.id},
+                audit="API Key for {}#{} (`{}`) was reset by {}#{} (`{}`)".format(user.name, user.discriminator, user.id, ctx.author.name, ctx.author.discriminator, ctx.author.id),
+            )
+            await ctx.reply("API Key for {}#{} (`{}`) was reset.".format(user.name, user.discriminator, user.id))
+        except APIQueued:
+            await ctx.reply("The backend is busy, the change for {}#{} (`{}`) was queued and will be applied once it catches up.".format(user.name, user.discriminator, user.id))
+        except Exception as e:
+            logger.exception("[Discord]", exc_info=e)
+            await ctx.reply("An error occurred while resetting user API Key: {}".format(e))
+
+    @commands.hybrid_command(hidden=True, help="Lists user flags", name="flags")
+    async def list_flags(self, ctx: commands.Context):
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+        names = []
+        for name in UserFlags._member_names_:
+            names.append(f"``{name}``")
+
+        await ctx.reply(f"Valid user flags:\n{', '.join(names)}")
+
+    @commands.hybrid_command(hidden=True, help="Update a users flags, several flags can be separated by commas")
+    async def update_flags(self, ctx: commands.Context, user: discord.User, action: str, flag: str):
+        flag = flag.upper()
+        action = action.upper()
+
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+
+        if action not in FlagAction._member_names_:
+            return await ctx.reply("Invalid action! Valid actions are ``add``, ``remove``")
+
+        # several flags can be given at once, e.g. "admin,beta_tester"
+        try:
+            flag_value = parse_flags(flag)
+        except ValueError:
+            names = []
+            for name in UserFlags._member_names_:
+                names.append(f"``{name}``")
+            return await ctx.reply(f"Invalid User Flag! Valid flags are {', '.join(names)}")
+
+        action_value = FlagAction[action].value
+
+        try:
+            await outbox.submit_and_wait(
+                OPCode.UPDATE_PERMISSIONS,
+                {"user_id": user.id, "permission_action": action_value, "permissions": flag_value},
+                audit="Permissions for {}#{} (`{}`) were updated by {}#{} (`{}`). {} {}".format(
+                    user.name, user.discriminator, user.id, ctx.author.name, ctx.author.discriminator, ctx.author.id, action_value, flag_value
+                ),
+            )
+            await ctx.reply("Permissions for {}#{} (`{}`) were updated.".format(user.name, user.discriminator, user.id))
+        except APIQueued:
+            await ctx.reply("The backend is busy, the change for {}#{} (`{}`) was queued and will be applied once it catches up.".format(user.name, user.discriminator, user.id))
+        except Exception as e:
+            logger.exception("[Discord]", exc_info=e)
+            await ctx.reply("An error occurred while updating user permissions: {}".format(e))
+
+    @commands.hybrid_command(hidden=True, help="Disable every user id in an attached text or csv file")
+    async def bulk_disable(self, ctx: commands.Context, file: discord.Attachment):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+
+        async def send(chunk: List[int]):
+            await outbox.submit_and_wait(OPCode.DISABLE_USER_BULK, {"user_ids": chunk})
+
+        await run_bulk_command(ctx, file, "Bulk disable", send, SYNC_CHUNK_SIZE, BULK_CONCURRENCY)
+
+    @commands.hybrid_command(hidden=True, help="Enable every user id in an attached text or csv file")
+    async def bulk_enable(self, ctx: commands.Context, file: discord.Attachment):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+        send = send_per_user(OPCode.ENABLE_USER, lambda user_id: {"user_id": user_id})
+        await run_bulk_command(ctx, file, "Bulk enable", send, 1, OUTBOX_BATCH_SIZE)
+
+    @commands.hybrid_command(hidden=True, help="Reset the API Key of every user id in an attached text or csv file")
+    async def bulk_reset_api_key(self, ctx: commands.Context, file: discord.Attachment):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+        send = send_per_user(OPCode.RESET_API_KEY, lambda user_id: {"user_id": user_id})
+        await run_bulk_command(ctx, file, "Bulk API Key reset", send, 1, OUTBOX_BATCH_SIZE)
+
+    @commands.hybrid_command(hidden=True, help="Update the flags of every user id in an attached text or csv file, several flags can be separated by commas")
+    async def bulk_update_flags(self, ctx: commands.Context, file: discord.Attachment, action: str, flags: str):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+
+        action = action.upper()
+        if action not in FlagAction._member_names_:
+            return await ctx.reply("Invalid action! Valid actions are ``add``, ``remove``")
+        try:
+            flag_value = parse_flags(flags)
+        except ValueError:
+            names = []
+            for name in UserFlags._member_names_:
+                names.append(f"``{name}``")
+            return await ctx.reply(f"Invalid User Flag! Valid flags are {', '.join(names)}")
+
+        action_value = FlagAction[action].value
+        send = send_per_user(OPCode.UPDATE_PERMISSIONS, lambda user_id: {"user_id": user_id, "permission_action": action_value, "permissions": flag_value})
+        await run_bulk_command(ctx, file, "Bulk flag update ({} {})".format(action_value, flag_value), send, 1, OUTBOX_BATCH_SIZE)
+
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(Admin())
@@ -0,0 +1,154 @@
+import logging
+from typing import Union
+
+import discord
+from discord.ext import commands
+
+from getwvkeysbot.config import GUILD_ID, LEAN_MEMBER_CACHE
+from getwvkeysbot.dm import DMQueue
+from getwvkeysbot.members import MemberIndex, member_index
+from getwvkeysbot.metrics import metrics
+from getwvkeysbot.outbox import Outbox
+from getwvkeysbot.redis import OPCode
+from getwvkeysbot.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class MemberEvents(commands.Cog):
+    """Disables and enables accounts when members of the main guild are banned, leave or change roles."""
+
+    def __init__(self, outbox: Outbox, dm_queue: DMQueue, member_index: MemberIndex = member_index, lean: bool = LEAN_MEMBER_CACHE, guild_id: int = GUILD_ID):
+        self.outbox = outbox
+        self.dm_queue = dm_queue
+        self.member_index = member_index
+        self.lean = lean
+        self.guild_id = guild_id
+
+    # handles banning of users
+    @commands.Cog.listener()
+    @metrics.instrument_event
+    async def on_member_ban(self, guild: discord.Guild, user: Union[discord.User, discord.Member]):
+        # ignore servers that are not the main server
+        if guild.id != self.guild_id:
+            return
+
+        # ignore bots
+        if user.bot:
+            return
+
+        # ignore users that are not verified, without a member cache the user may not carry any roles
+        if not settings.verified_role in getattr(user, "_roles", ()) and not self.member_index.is_verified(user.id):
+            return
+
+        logger.info("[Discord] User {}#{} (`{}`) was banned from {}".format(user.name, user.discriminator, user.id, guild.name))
+
+        try:
+            self.outbox.submit(
+                OPCode.DISABLE_USER,
+                {"user_id": user.id},
+                audit="User {}#{} (`{}`) was banned, their account has been disabled.".format(user.name, user.discriminator, user.id),
+                failure="An error occurred while trying to disable user {}:{} (`{}`) from the database. <@&975780356970123265>".format(user.name, user.discriminator, user.id),
+            )
+        except Exception as e:
+            logger.exception("[Discord]", exc_info=e)
+
+    # handles kicking and leaving of users
+    @commands.Cog.listener()
+    @metrics.instrument_event
+    async def on_member_remove(self, user: Union[discord.User, discord.Member]):
+        # ignore servers that are not the main server
+        if user.guild.id != self.guild_id:
+            return
+
+        # ignore bots
+        if user.bot:
+            return
+
+        # ignore users that are not verified
+        if not settings.verified_role in user._roles:
+            return
+
+        logger.info("[Discord] User {}#{} (`{}`) was removed from {}".format(user.name, user.discriminator, user.id, user.guild.name))
+        self.submit_removed_user(user)
+
+    # member_remove is only dispatched for cached members, the lean mode checks the member index instead
+    @commands.Cog.listener()
+    @metrics.instrument_event
+    async def on_raw_member_remove(self, payload: discord.RawMemberRemoveEvent):
+        if not self.lean or payload.guild_id != self.guild_id or payload.user.bot:
+            return
+
+        if not self.member_index.remove(payload.user.id):
+            return
+
+        user = payload.user
+        logger.info("[Discord] User {}#{} (`{}`) was removed from {}".format(user.name, user.discriminator, user.id, payload.guild_id))
+        self.submit_removed_user(user)
+
+    def submit_removed_user(self, user: Union[discord.User, discord.Member]):
+        try:
+            self.outbox.submit(
+                OPCode.DISABLE_USER,
+                {"user_id": user.id},
+                audit="User {}#{} (`{}`) was removed, their account has been disabled.".format(user.name, user.discriminator, user.id),
+                failure="An error occurred while trying to disable user {}:{} (`{}`). <@&975780356970123265>".format(user.name, user.discriminator, user.id),
+            )
+        except Exception as e:
+            logger.exception("[Discord]", exc_info=e)
+
+    # handles role changes of users
+    @commands.Cog.listener()
+    @metrics.instrument_event
+    async def on_member_update(self, old: discord.Member, new: discord.Member):
+        # ignore servers that are not the main server
+        if new.guild.id != self.guild_id:
+            return
+
+        if old.bot:
+            # ignore bots
+            return
+
+        if old._roles == new._roles:
+            # ignore any updates that don't change roles
+            return
+
+        verified_role = settings.verified_role
+        # checks if the verified role was removed from a user
+        if verified_role not in new._roles and verified_role in old._roles:
+            self.submit_verified_change(new, False)
+
+        # checks if the verified role was given to a user
+        if verified_role in new._roles and verified_role not in old._roles:
+            self.submit_verified_change(new, True)
+
+    # dispatched by the member index in the lean mode, where member_update is not
+    @commands.Cog.listener()
+    @metrics.instrument_event
+    async def on_verified_update(self, member: discord.Member, verified: bool):
+        self.submit_verified_change(member, verified)
+
+    def submit_verified_change(self, member: discord.Member, verified: bool):
+        if not verified:
+            self.outbox.submit(
+                OPCode.DISABLE_USER,
+                {"user_id": member.id},
+                audit="User {}#{} (`{}`) was unverified, their account has been disabled.".format(member.name, member.discriminator, member.id),
+                failure="An error occurred while trying to disable user {}:{} (`{}`). <@&975780356970123265>".format(member.name, member.discriminator, member.id),
+            )
+        else:
+            entry_id = self.outbox.submit(
+                OPCode.ENABLE_USER,
+                {"user_id": member.id},
+                audit="User {}#{} (`{}`) was verified, their account has been enabled.".format(member.name, member.discriminator, member.id),
+                failure="An error occurred while trying to enable user {}:{} (`{}`). <@&975780356970123265>".format(member.name, member.discriminator, member.id),
+            )
+            # only tell the user once their account has actually been enabled
+            self.dm_queue.put_after(self.outbox.wait(entry_id), member.id, "Your request for verification has been approved!")
+
+
+async def setup(bot: commands.Bot):
+    # imported here so the handlers can be used without creating the bot, e.g. by benchmarks.storm
+    from getwvkeysbot.bot import dm_queue, outbox
+
+    await bot.add_cog(MemberEvents(outbox, dm_queue))
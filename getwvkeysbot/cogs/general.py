@@ -0,0 +1,121 @@
+import logging
+import time
+
+import discord
+from discord.ext import commands
+
+from getwvkeysbot.cache import count_cache
+from getwvkeysbot.config import SEARCH_PAGE_SIZE
+from getwvkeysbot.metrics import metrics
+from getwvkeysbot.pssh import parse_search_query
+from getwvkeysbot.redis import OPCode, redis_cli
+from getwvkeysbot.search import SearchPaginator, build_embed, build_results_file, fetch_page
+from getwvkeysbot.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+def has_script_dev_role():
+    # like commands.has_role, but the role is looked up on every invocation so settings reloads apply
+    async def predicate(ctx: commands.Context) -> bool:
+        if not isinstance(ctx.author, discord.Member):
+            raise commands.NoPrivateMessage()
+        if settings.script_dev_role_id not in ctx.author._roles:
+            raise commands.MissingRole(settings.script_dev_role_id)
+        return True
+
+    return commands.check(predicate)
+
+
+class General(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    @commands.hybrid_command(help="Pong!")
+    async def ping(self, ctx: commands.Context):
+        start = time.perf_counter()
+        try:
+            await redis_cli.ping()
+            redis_latency = "{}ms".format(round((time.perf_counter() - start) * 1000))
+        except Exception as e:
+            logger.warning("[Redis] Ping failed: {}".format(e))
+            redis_latency = "unreachable"
+        # the API has no cheap op to time here, so show the last real request and how old it is
+        if metrics.last_request_latency is not None:
+            api_latency = "{}ms ({}, {}s ago)".format(round(metrics.last_request_latency * 1000), metrics.last_request_op, round(time.monotonic() - metrics.last_request_at))
+        else:
+            api_latency = "n/a"
+        await ctx.reply(f"Pong! Gateway: {round(self.bot.latency * 1000)}ms, Redis: {redis_latency}, last API request: {api_latency}")
+
+    @commands.hybrid_command(name="usercount", help="Get the number of users that have registered on the site.")
+    async def user_count(self, ctx: commands.Context):
+        try:
+            await ctx.defer()
+            count = await count_cache.get(OPCode.USER_COUNT)
+            await ctx.reply("There are currently {} users in the database.".format(count))
+        except Exception as e:
+            logger.exception(e)
+            await ctx.reply("An error occurred while fetching the user count: {}".format(e))
+
+    @commands.hybrid_command(name="keycount", help="Get the number of cached keys in the database.")
+    async def key_count(self, ctx: commands.Context):
+        try:
+            count = await count_cache.get(OPCode.KEY_COUNT)
+            await ctx.reply("There are currently {} keys in the database.".format(count))
+        except Exception as e:
+            logger.exception(e)
+            await ctx.reply("An error occurred while fetching the key count: {}".format(e))
+
+    @commands.hybrid_command(name="search", usage="<kid or pssh> [as_file]", help="Search for a key by kid or pssh, every kid in a pssh is looked up.")
+    # @commands.has_role(VERIFIED_ROLE)
+    async def key_search(self, ctx: commands.Context, query: str, as_file: bool = False):
+        # malformed queries are rejected here, without a round trip to the API
+        try:
+            parse_search_query(query)
+        except ValueError:
+            return await ctx.reply("Sorry, your query is not valid.")
+        m = await ctx.reply(content="Searching...")
+        try:
+            page = await fetch_page(query, 0, SEARCH_PAGE_SIZE)
+            if page is None:
+                return await m.edit(content="The response was null. Please report this to the developers.")
+            if page.total == 0:
+                return await m.edit(content="There were no results. sadface.")
+
+            if as_file:
+                return await m.edit(content="Found **{}** result{}".format(page.total, "s" if page.total != 1 else ""), attachments=[await build_results_file(query, page.kid)])
+
+            view = SearchPaginator(ctx.author.id, query, page)
+            view.message = await m.edit(embed=build_embed(query, page), content="", view=view)
+        except Exception as e:
+            logger.exception(e)
+            await m.edit(content="An error occurred while searching: {}".format(e))
+
+    @commands.hybrid_command(help="Pin a message to the thread. (for script developers)", name="pin")
+    @has_script_dev_role()
+    async def pin_message_to_thread_channel(self, ctx: commands.Context, message_id: str):
+        if ctx.message.channel.type != discord.ChannelType.public_thread:
+            return await ctx.reply("This command can only be used in a thread channel.", ephemeral=True)
+        if ctx.message.channel.parent_id != settings.scripts_channel_id:
+            return await ctx.reply("This command can only be used in a script thread channel.", ephemeral=True)
+        if ctx.message.channel.owner_id != ctx.message.author.id:
+            return await ctx.reply("You can only pin messages to your own thread channel.", ephemeral=True)
+
+        message = await ctx.fetch_message(message_id)
+        if message is None:
+            return await ctx.reply("Invalid message ID.", ephemeral=True)
+        if message.channel.id != ctx.message.channel.id:
+            return await ctx.reply("Message is not in this thread channel.", ephemeral=True)
+        if message.author.id != ctx.message.author.id:
+            return await ctx.reply("You can only pin your own messages.", ephemeral=True)
+
+        try:
+            await message.pin()
+            await ctx.reply("Message pinned.", ephemeral=True)
+        except Exception as e:
+            logger.exception("[Discord]", exc_info=e)
+            await ctx.reply("An error occurred while pinning message: {}".format(e), ephemeral=True)
+
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(General(bot))
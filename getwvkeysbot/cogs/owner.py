@@ -0,0 +1,99 @@
+import logging
+from typing import Optional
+
+from discord.ext import commands
+
+from getwvkeysbot.bot import EXTENSIONS, audit, is_admin
+from getwvkeysbot.commandsync import sync_command_tree, sync_commands
+from getwvkeysbot.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Owner(commands.Cog):
+    """Commands to sync commands, reload extensions and change the live settings."""
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    @commands.command(help="Syncs commands", hidden=True)
+    @commands.is_owner()
+    async def synccommands(self, ctx: commands.Context, force: bool = False):
+        if await sync_command_tree(self.bot, force=force):
+            await ctx.reply("Synced commands.")
+        else:
+            await ctx.reply("Commands are already up to date, use `force` to sync anyway.")
+
+    @commands.command(hidden=True, help="Reload one extension, or all of them, without reconnecting")
+    async def reload(self, ctx: commands.Context, extension: Optional[str] = None):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+
+        if extension is None:
+            names = EXTENSIONS
+        else:
+            name = extension if "." in extension else "getwvkeysbot.cogs.{}".format(extension)
+            if name not in self.bot.extensions:
+                return await ctx.reply("Unknown extension `{}`, loaded extensions are {}".format(extension, ", ".join("`{}`".format(e.rsplit(".", 1)[-1]) for e in self.bot.extensions)))
+            names = [name]
+
+        reloaded, failed = [], []
+        for name in names:
+            try:
+                # discord.py keeps the previous version loaded when the new one fails to import or set up
+                await self.bot.reload_extension(name)
+                reloaded.append(name)
+            except commands.ExtensionError as e:
+                logger.exception("[Extensions] Failed to reload {}".format(name), exc_info=e)
+                failed.append("`{}`: {}".format(name, e.__cause__ or e))
+
+        content = "Reloaded {}.".format(", ".join("`{}`".format(name) for name in reloaded) or "nothing")
+        if failed:
+            content += "\nFailed, the previous version is still loaded:\n{}".format("\n".join(failed))
+        try:
+            if await sync_commands(self.bot):
+                content += "\nThe slash commands changed and were synced."
+        except Exception as e:
+            logger.exception("[Discord] Failed to sync commands after a reload", exc_info=e)
+            content += "\nFailed to sync the slash commands: {}".format(e)
+        audit.log("Extensions {} were reloaded by {}#{} (`{}`)".format(", ".join(reloaded) or "none", ctx.author.name, ctx.author.discriminator, ctx.author.id))
+        await ctx.reply(content[:2000])
+
+    @commands.command(hidden=True, help="Reload the live settings on every process")
+    async def reloadconfig(self, ctx: commands.Context):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+        try:
+            changed = await settings.reload()
+            # the other processes reload when they receive this
+            await settings.publish()
+        except Exception as e:
+            logger.exception("[Settings] Reload failed", exc_info=e)
+            return await ctx.reply("Failed to reload the settings, the previous ones are still in use: {}".format(e))
+        await ctx.reply("Settings reloaded, {}.".format("changed " + ", ".join("`{}`".format(name) for name in sorted(changed)) if changed else "nothing changed"))
+
+    @commands.command(hidden=True, help="Show the live settings, or change one. Leave the value out to go back to the default")
+    async def setting(self, ctx: commands.Context, name: Optional[str] = None, *, value: Optional[str] = None):
+        # only allow admins to use command
+        if not is_admin(ctx.author):
+            return await ctx.reply("You're not elite enough, try harder.")
+
+        if name is None:
+            lines = ["`{}`: {}{}".format(key, value, " (override)" if key in settings.overrides else "") for key, value in settings.values().items()]
+            return await ctx.reply("\n".join(lines))
+
+        try:
+            # set publishes the change, every process including this one reloads when it receives it
+            await settings.set(name, value)
+        except ValueError as e:
+            return await ctx.reply(str(e))
+        # the reload has not necessarily run yet, show the value it will apply
+        new_value = settings.parse({} if value is None else {name: value})[name]
+        audit.log("Setting `{}` was set to {} by {}#{} (`{}`)".format(name, new_value, ctx.author.name, ctx.author.discriminator, ctx.author.id))
+        await ctx.reply("`{}` is now {}.".format(name, new_value))
+
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(Owner(bot))
@@ -0,0 +1,39 @@
+import hashlib
+import json
+import logging
+from typing import Optional
+
+import discord
+from discord.ext import commands
+
+from getwvkeysbot.config import DEVELOPMENT_GUILD, IS_DEVELOPMENT
+from getwvkeysbot.redis import redis_cli
+
+logger = logging.getLogger(__name__)
+
+
+def command_tree_hash(tree: discord.app_commands.CommandTree, guild: Optional[discord.abc.Snowflake] = None) -> str:
+    payload = [command.to_dict(tree) for command in tree.get_commands(guild=guild)]
+    payload.sort(key=lambda command: (command.get("type", 1), command["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+async def sync_command_tree(bot: commands.Bot, guild: Optional[discord.abc.Snowflake] = None, force: bool = False) -> bool:
+    # syncing is slow and rate limited, skip it when the tree is identical to the last synced one
+    key = "commands:hash:{}:{}".format(bot.application_id, guild.id if guild else "global")
+    digest = command_tree_hash(bot.tree, guild)
+    if not force and await redis_cli.get(key) == digest:
+        logger.info("[Discord] Command tree for {} is unchanged, skipping sync".format(guild.id if guild else "global"))
+        return False
+    await bot.tree.sync(guild=guild)
+    await redis_cli.set(key, digest)
+    logger.info("[Discord] Synced command tree for {}".format(guild.id if guild else "global"))
+    return True
+
+
+async def sync_commands(bot: commands.Bot) -> bool:
+    # the development guild gets a copy of the global commands, production syncs them globally
+    if IS_DEVELOPMENT:
+        bot.tree.copy_global_to(guild=discord.Object(id=DEVELOPMENT_GUILD))
+        return await sync_command_tree(bot, discord.Object(id=DEVELOPMENT_GUILD))
+    return await sync_command_tree(bot)
@@ -1,7 +1,8 @@
 import logging
 import os
 import pathlib
-import time
+import socket
+import uuid
 
 from dotenv import load_dotenv
 
@@ -13,9 +14,15 @@ load_dotenv(".env.dev" if IS_DEVELOPMENT else ".env")
 LOG_LEVEL = logging.DEBUG if IS_DEVELOPMENT else logging.INFO
 LOG_FORMAT = "[%(asctime)s] [%(name)s] [%(funcName)s:%(lineno)d] %(levelname)s: %(message)s"
 LOG_DATE_FORMAT = "%I:%M:%S"
-LOG_FILE_PATH = pathlib.Path(os.getcwd(), "logs", f"{time.strftime('%Y-%m-%d')}.log")
+LOG_FILE_PATH = pathlib.Path(os.getcwd(), "logs", "bot.log")
+# number of daily log files to keep
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 14))
+# optional JSON-lines log file for log shipping
+LOG_JSON_PATH = os.environ.get("LOG_JSON_PATH")
+# records are dropped instead of blocking the event loop once this many are waiting to be written
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
 
-# Channels and roles
+# Channels and roles, the defaults of the live settings in getwvkeysbot/settings.py
 LOG_CHANNEL_ID = 971335086609936384
 INTERROGATION_CHANNEL_ID = 981140722759651349
 SCRIPTS_CHANNEL_ID = 1049388138000302173
@@ -33,3 +40,96 @@ BOT_TOKEN = os.environ["BOT_TOKEN"]
 CLIENT_ID = os.environ["CLIENT_ID"]
 CLIENT_SECRET = os.environ["CLIENT_SECRET"]
 REDIS_URI = os.environ["REDIS_URI"]
+
+# Request coalescing settings
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", 0.5))
+COALESCE_MAX_BATCH = int(os.environ.get("COALESCE_MAX_BATCH", 500))
+
+# Ban sync settings
+SYNC_CHUNK_SIZE = int(os.environ.get("SYNC_CHUNK_SIZE", 1000))
+SYNC_CHECKPOINT_TTL = int(os.environ.get("SYNC_CHECKPOINT_TTL", 60 * 60 * 24 * 7))
+
+# Cache settings
+COUNT_CACHE_TTL = float(os.environ.get("COUNT_CACHE_TTL", 60))
+COUNT_CACHE_REFRESH_AHEAD = float(os.environ.get("COUNT_CACHE_REFRESH_AHEAD", 10))
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 1024))
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", 300))
+SEARCH_CACHE_NEGATIVE_TTL = float(os.environ.get("SEARCH_CACHE_NEGATIVE_TTL", 30))
+SEARCH_CACHE_INVALIDATION_CHANNEL = os.environ.get("SEARCH_CACHE_INVALIDATION_CHANNEL", "search-invalidate")
+
+# Search settings
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", 10))
+SEARCH_FILE_PAGE_SIZE = int(os.environ.get("SEARCH_FILE_PAGE_SIZE", 1000))
+
+# Audit log settings
+AUDIT_FLUSH_INTERVAL = float(os.environ.get("AUDIT_FLUSH_INTERVAL", 5))
+AUDIT_MAX_MESSAGES_PER_FLUSH = int(os.environ.get("AUDIT_MAX_MESSAGES_PER_FLUSH", 4))
+AUDIT_QUEUE_SIZE = int(os.environ.get("AUDIT_QUEUE_SIZE", 10000))
+AUDIT_MAX_SEND_ATTEMPTS = int(os.environ.get("AUDIT_MAX_SEND_ATTEMPTS", 5))
+AUDIT_CLOSE_TIMEOUT = float(os.environ.get("AUDIT_CLOSE_TIMEOUT", 10))
+
+# API request settings
+API_DEFAULT_DEADLINE = float(os.environ.get("API_DEFAULT_DEADLINE", 15))
+API_MAX_RETRIES = int(os.environ.get("API_MAX_RETRIES", 2))
+API_RETRY_BACKOFF = float(os.environ.get("API_RETRY_BACKOFF", 0.5))
+API_BREAKER_THRESHOLD = int(os.environ.get("API_BREAKER_THRESHOLD", 5))
+API_BREAKER_RESET_TIMEOUT = float(os.environ.get("API_BREAKER_RESET_TIMEOUT", 30))
+
+# Metrics settings, the scrape endpoint is disabled unless a port is set
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+
+# API transport settings, "streams" sends moderation requests through a durable redis stream
+API_TRANSPORT = os.environ.get("API_TRANSPORT", "pubsub")
+API_STREAM = os.environ.get("API_STREAM", "api-stream")
+API_STREAM_GROUP = os.environ.get("API_STREAM_GROUP", "api")
+API_STREAM_MAXLEN = int(os.environ.get("API_STREAM_MAXLEN", 100000))
+API_STREAM_DEADLINE = float(os.environ.get("API_STREAM_DEADLINE", 30))
+
+# Payload encoding settings, binary formats are only used once the API advertises them in API_CAPABILITIES_KEY
+API_CAPABILITIES_KEY = os.environ.get("API_CAPABILITIES_KEY", "api:capabilities")
+API_CAPABILITIES_REFRESH = float(os.environ.get("API_CAPABILITIES_REFRESH", 60))
+PAYLOAD_COMPRESSION_THRESHOLD = int(os.environ.get("PAYLOAD_COMPRESSION_THRESHOLD", 4096))
+PAYLOAD_PACK_MIN_IDS = int(os.environ.get("PAYLOAD_PACK_MIN_IDS", 64))
+
+# Verified member reconciliation settings, the interval is in minutes
+RECONCILE_INTERVAL = float(os.environ.get("RECONCILE_INTERVAL", 30))
+
+# Outbox settings, mutating requests are stored here until the API has processed them
+OUTBOX_PATH = pathlib.Path(os.environ.get("OUTBOX_PATH", pathlib.Path(os.getcwd(), "data", "outbox.sqlite3")))
+OUTBOX_RATE = float(os.environ.get("OUTBOX_RATE", 50))
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 100))
+OUTBOX_WAIT_TIMEOUT = float(os.environ.get("OUTBOX_WAIT_TIMEOUT", 10))
+
+# Bulk admin command settings, user ids are sent in chunks of SYNC_CHUNK_SIZE where the API supports it
+BULK_CONCURRENCY = int(os.environ.get("BULK_CONCURRENCY", 4))
+BULK_PROGRESS_INTERVAL = float(os.environ.get("BULK_PROGRESS_INTERVAL", 2))
+
+# DM delivery settings, DMs are sent at DM_RATE per second with bursts of up to DM_BURST
+DM_RATE = float(os.environ.get("DM_RATE", 1))
+DM_BURST = int(os.environ.get("DM_BURST", 5))
+DM_MAX_ATTEMPTS = int(os.environ.get("DM_MAX_ATTEMPTS", 5))
+DM_DEAD_LETTER_SIZE = int(os.environ.get("DM_DEAD_LETTER_SIZE", 1000))
+
+# Live settings, overrides of the channel, role and admin ids above are read from this redis hash
+# and reloaded by every process when a message is published on SETTINGS_CHANNEL
+SETTINGS_KEY = os.environ.get("SETTINGS_KEY", "config:live")
+SETTINGS_CHANNEL = os.environ.get("SETTINGS_CHANNEL", "config-reload")
+
+# Lean member cache, members aren't cached or chunked and only verified and admin member ids are tracked
+LEAN_MEMBER_CACHE = bool(os.environ.get("LEAN_MEMBER_CACHE", False))
+
+# Sharding and clustering settings
+SHARDED = bool(os.environ.get("SHARDED", False))
+SHARD_COUNT = int(os.environ["SHARD_COUNT"]) if os.environ.get("SHARD_COUNT") else None
+SHARD_IDS = [int(x) for x in os.environ["SHARD_IDS"].split(",")] if os.environ.get("SHARD_IDS") else None
+# number of bot processes sharing the shards, each process claims one slot through redis
+CLUSTER_SIZE = int(os.environ.get("CLUSTER_SIZE", 1))
+CLUSTER_NODE_ID = os.environ.get("CLUSTER_NODE_ID") or "{}-{}".format(socket.gethostname(), uuid.uuid4().hex[:8])
+CLUSTER_NODE_TTL = int(os.environ.get("CLUSTER_NODE_TTL", 30))
+
+if CLUSTER_SIZE > 1 and (not SHARDED or SHARD_COUNT is None):
+    raise ValueError("CLUSTER_SIZE > 1 requires SHARDED and SHARD_COUNT to be set")
+if CLUSTER_SIZE > 1 and CLUSTER_SIZE > SHARD_COUNT:
+    # a slot without shards would leave shard_ids empty, and discord.py launches every shard then
+    raise ValueError("CLUSTER_SIZE can't be larger than SHARD_COUNT")
@@ -0,0 +1,193 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import discord
+
+from getwvkeysbot.config import DM_BURST, DM_DEAD_LETTER_SIZE, DM_MAX_ATTEMPTS, DM_RATE
+from getwvkeysbot.redis import APIQueued, redis_cli
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# discord error codes
+CANNOT_MESSAGE_USER = 50007
+UNKNOWN_USER = 10013
+OPENING_DMS_TOO_FAST = 40003
+
+DEAD_LETTER_KEY = "dm:dead-letter"
+
+
+class DMJob:
+    __slots__ = ("user_id", "content", "priority", "attempts", "created_at")
+
+    def __init__(self, user_id: int, content: str, priority: int):
+        self.user_id = user_id
+        self.content = content
+        self.priority = priority
+        self.attempts = 0
+        self.created_at = time.time()
+
+
+class DMQueue:
+    """
+    Background delivery of direct messages.
+
+    Callers only enqueue. A single worker sends the highest priority message first, paced by a
+    token bucket of ``rate`` messages per second. When Discord says DMs are being opened too fast
+    the whole queue pauses, other failures are retried with exponential backoff. Messages to users
+    that can't be messaged, or that ran out of attempts, are recorded in a capped dead-letter list
+    in Redis.
+    """
+
+    def __init__(self, bot: discord.Client, rate: float = DM_RATE, burst: int = DM_BURST, max_attempts: int = DM_MAX_ATTEMPTS, redis_cli=redis_cli):
+        self.bot = bot
+        self.rate = rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.redis = redis_cli
+        self._counter = itertools.count()
+        # (priority, sequence, job) of messages that can be sent now, (due, sequence, job) of retries
+        self._ready: List[Tuple[int, int, DMJob]] = []
+        self._delayed: List[Tuple[float, int, DMJob]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._recent_sends = deque(maxlen=10000)
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+
+    def put(self, user_id: int, content: str, priority: int = PRIORITY_NORMAL):
+        job = DMJob(user_id, content, priority)
+        heapq.heappush(self._ready, (priority, next(self._counter), job))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def put_after(self, future: asyncio.Future, user_id: int, content: str, priority: int = PRIORITY_NORMAL):
+        # enqueue once ``future`` succeeds, e.g. an outbox entry the message is about, or the API queued it
+        def enqueue(done: asyncio.Future):
+            if not done.cancelled() and (done.exception() is None or isinstance(done.exception(), APIQueued)):
+                self.put(user_id, content, priority)
+
+        future.add_done_callback(enqueue)
+
+    def backlog(self) -> Dict[str, int]:
+        pending = {"high": 0, "normal": 0, "low": 0}
+        names = {PRIORITY_HIGH: "high", PRIORITY_NORMAL: "normal", PRIORITY_LOW: "low"}
+        for priority, _, _ in self._ready:
+            pending[names.get(priority, "low")] += 1
+        pending["retrying"] = len(self._delayed)
+        return pending
+
+    def sent_per_minute(self) -> int:
+        cutoff = time.monotonic() - 60
+        while self._recent_sends and self._recent_sends[0] < cutoff:
+            self._recent_sends.popleft()
+        return len(self._recent_sends)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.backlog(), "sent": self.sent, "retried": self.retried, "dead": self.dead, "per_minute": self.sent_per_minute()}
+
+    async def dead_letters(self, limit: int = 20) -> List[dict]:
+        return [json.loads(entry) for entry in await self.redis.lrange(DEAD_LETTER_KEY, 0, limit - 1)]
+
+    async def _run(self):
+        while True:
+            try:
+                job = await self._next_job()
+                await self._throttle()
+                await self._deliver(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("[DM] Delivery worker failed", exc_info=e)
+                await asyncio.sleep(1)
+
+    async def _next_job(self) -> DMJob:
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, sequence, job = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (job.priority, sequence, job))
+            if self._ready:
+                return heapq.heappop(self._ready)[2]
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _throttle(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _deliver(self, job: DMJob):
+        job.attempts += 1
+        try:
+            channel = await self.bot.create_dm(discord.Object(id=job.user_id))
+            await channel.send(job.content)
+        except discord.Forbidden as e:
+            if e.code == CANNOT_MESSAGE_USER:
+                # DMs are closed or the bot is blocked, retrying won't help
+                return await self._dead_letter(job, "DMs closed")
+            return await self._retry(job, e)
+        except discord.NotFound as e:
+            if e.code == UNKNOWN_USER:
+                return await self._dead_letter(job, "unknown user")
+            return await self._retry(job, e)
+        except discord.HTTPException as e:
+            if e.code == OPENING_DMS_TOO_FAST or e.status == 429:
+                # every route is affected, hold the whole queue back
+                pause = min(600, 30 * job.attempts)
+                self._paused_until = time.monotonic() + pause
+                logger.warning("[DM] Rate limited by Discord, pausing DM delivery for {}s".format(pause))
+            return await self._retry(job, e)
+        except (OSError, asyncio.TimeoutError) as e:
+            return await self._retry(job, e)
+
+        self.sent += 1
+        self._recent_sends.append(time.monotonic())
+
+    async def _retry(self, job: DMJob, error: Exception):
+        if job.attempts >= self.max_attempts:
+            return await self._dead_letter(job, str(error))
+        delay = min(600, 5 * 2 ** (job.attempts - 1))
+        self.retried += 1
+        logger.warning("[DM] Failed to message {} ({}), retrying in {}s".format(job.user_id, error, delay))
+        heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._counter), job))
+
+    async def _dead_letter(self, job: DMJob, reason: str):
+        self.dead += 1
+        logger.warning("[DM] Giving up on messaging {} after {} attempts: {}".format(job.user_id, job.attempts, reason))
+        entry = {"user_id": job.user_id, "content": job.content, "reason": reason, "attempts": job.attempts, "created_at": job.created_at, "failed_at": time.time()}
+        try:
+            await self.redis.lpush(DEAD_LETTER_KEY, json.dumps(entry))
+            await self.redis.ltrim(DEAD_LETTER_KEY, 0, DM_DEAD_LETTER_SIZE - 1)
+        except Exception as e:
+            logger.exception("[DM] Failed to record a dead letter for {}".format(job.user_id), exc_info=e)
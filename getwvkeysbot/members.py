@@ -0,0 +1,120 @@
+import logging
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import discord
+from discord.ext import commands
+
+from getwvkeysbot.config import GUILD_ID
+from getwvkeysbot.reconcile import VerifiedReconciler, unpack_ids
+from getwvkeysbot.redis import raw_redis_cli
+from getwvkeysbot.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class MemberIndex:
+    """
+    Verified and admin member ids of the main guild, for running without a member cache.
+
+    Without cached members discord.py drops GUILD_MEMBER_UPDATE events, so the index hooks the raw
+    parser instead and dispatches ``on_verified_update(member, verified)`` whenever a member gains or
+    loses the verified role. It is seeded from the last reconcile snapshot and then refreshed from
+    the member list over REST.
+    """
+
+    def __init__(self, guild_id: int = GUILD_ID, redis_cli=raw_redis_cli):
+        self.guild_id = guild_id
+        self.redis = redis_cli
+        self.verified: Set[int] = set()
+        self.admins: Set[int] = set()
+        self.loaded = False
+        # updates that arrive while the member list is being fetched, applied on top of it
+        self._changes: Optional[Dict[int, Tuple[bool, bool]]] = None
+
+    def is_verified(self, user_id: int) -> bool:
+        return user_id in self.verified
+
+    def is_admin(self, user_id: int) -> bool:
+        return user_id in self.admins
+
+    def update(self, user_id: int, role_ids: Iterable[int]) -> Tuple[bool, bool]:
+        # returns whether the member was verified before and after the update
+        role_ids = set(role_ids)
+        was_verified = user_id in self.verified
+        verified = settings.verified_role in role_ids
+        admin = not role_ids.isdisjoint(settings.admin_roles)
+        self._set(user_id, verified, admin)
+        if self._changes is not None:
+            self._changes[user_id] = (verified, admin)
+        return was_verified, verified
+
+    def remove(self, user_id: int) -> bool:
+        # returns whether the member was verified
+        was_verified = user_id in self.verified
+        self._set(user_id, False, False)
+        if self._changes is not None:
+            self._changes[user_id] = (False, False)
+        return was_verified
+
+    def _set(self, user_id: int, verified: bool, admin: bool):
+        if verified:
+            self.verified.add(user_id)
+        else:
+            self.verified.discard(user_id)
+        if admin:
+            self.admins.add(user_id)
+        else:
+            self.admins.discard(user_id)
+
+    async def load(self, guild: discord.Guild):
+        data = await self.redis.get(VerifiedReconciler.snapshot_key(guild.id))
+        if data and not self.loaded:
+            # good enough to tell role changes apart until the member list has been fetched
+            self.verified |= unpack_ids(data)
+
+        self._changes = {}
+        try:
+            verified, admins = set(), set()
+            async for member in guild.fetch_members(limit=None):
+                if member.bot:
+                    continue
+                if settings.verified_role in member._roles:
+                    verified.add(member.id)
+                if not settings.admin_roles.isdisjoint(member._roles):
+                    admins.add(member.id)
+            self.verified, self.admins = verified, admins
+            for user_id, (is_verified, is_admin) in self._changes.items():
+                self._set(user_id, is_verified, is_admin)
+        finally:
+            self._changes = None
+        self.loaded = True
+        logger.info("[Members] Indexed {} verified and {} admin members of {}".format(len(self.verified), len(self.admins), guild.id))
+
+    def install(self, bot: commands.Bot):
+        state = bot._connection
+        parse_member_update = state.parsers["GUILD_MEMBER_UPDATE"]
+
+        def parse_guild_member_update(data):
+            try:
+                self._handle_member_update(bot, data)
+            except Exception as e:
+                logger.exception("[Members] Failed to index a member update", exc_info=e)
+            parse_member_update(data)
+
+        state.parsers["GUILD_MEMBER_UPDATE"] = parse_guild_member_update
+
+    def _handle_member_update(self, bot: commands.Bot, data: dict):
+        if int(data["guild_id"]) != self.guild_id or data["user"].get("bot"):
+            return
+        was_verified, verified = self.update(int(data["user"]["id"]), map(int, data["roles"]))
+        if was_verified == verified:
+            return
+        guild = bot.get_guild(self.guild_id)
+        if guild is None:
+            return
+        # the update carries the full member, so there is no need to fetch it
+        member = discord.Member(data=data, guild=guild, state=bot._connection)
+        bot.dispatch("verified_update", member, verified)
+
+
+member_index = MemberIndex()
@@ -0,0 +1,187 @@
+import bisect
+import functools
+import logging
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from getwvkeysbot.config import METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, anything slower lands in the implicit +Inf bucket
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        # estimated by interpolating inside the bucket the quantile falls in
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    In-process counters, gauges and latency histograms for API requests and gateway events.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._started_monotonic = time.monotonic()
+        # seconds from process start to each startup milestone, recorded once
+        self.startup: Dict[str, float] = {}
+        self.requests: Dict[str, int] = defaultdict(int)
+        self.request_errors: Dict[str, int] = defaultdict(int)
+        self.request_latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.inflight: Dict[str, int] = defaultdict(int)
+        # the most recent API request, whatever op it was and however long ago, shown by the ping command
+        self.last_request_latency: Optional[float] = None
+        self.last_request_op: Optional[str] = None
+        self.last_request_at: Optional[float] = None
+        self.events: Dict[str, int] = defaultdict(int)
+        self.event_errors: Dict[str, int] = defaultdict(int)
+        self.event_latency: Dict[str, Histogram] = defaultdict(Histogram)
+        # timestamps of recently handled events, for the per minute rate
+        self._recent_events = deque(maxlen=100000)
+        # gauges owned by other components, read when rendering
+        self._gauges: Dict[str, Tuple[str, Callable[[], Dict[str, float]]]] = {}
+
+    def register_gauge(self, name: str, help: str, read: Callable[[], Dict[str, float]]):
+        # ``read`` returns the current value per label value
+        self._gauges[name] = (help, read)
+
+    @contextmanager
+    def track_request(self, op: str):
+        self.requests[op] += 1
+        self.inflight[op] += 1
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.request_errors[op] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.inflight[op] -= 1
+            self.request_latency[op].observe(elapsed)
+            self.last_request_latency = elapsed
+            self.last_request_op = op
+            self.last_request_at = time.monotonic()
+
+    def instrument_event(self, func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            self.events[name] += 1
+            self._recent_events.append(time.monotonic())
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except BaseException:
+                self.event_errors[name] += 1
+                raise
+            finally:
+                self.event_latency[name].observe(time.perf_counter() - start)
+
+        return wrapper
+
+    def mark_startup(self, phase: str) -> float:
+        if phase not in self.startup:
+            self.startup[phase] = time.monotonic() - self._started_monotonic
+            logger.info("[Startup] {} after {:.2f}s".format(phase, self.startup[phase]))
+        return self.startup[phase]
+
+    def events_per_minute(self) -> int:
+        cutoff = time.monotonic() - 60
+        while self._recent_events and self._recent_events[0] < cutoff:
+            self._recent_events.popleft()
+        return len(self._recent_events)
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = []
+        _render_counter(lines, "getwvkeysbot_api_requests_total", "API requests sent", "op", self.requests)
+        _render_counter(lines, "getwvkeysbot_api_request_errors_total", "API requests that failed", "op", self.request_errors)
+        _render_gauge(lines, "getwvkeysbot_api_requests_inflight", "API requests waiting for a reply", "op", self.inflight)
+        _render_histogram(lines, "getwvkeysbot_api_request_seconds", "API request latency", "op", self.request_latency)
+        _render_counter(lines, "getwvkeysbot_events_total", "Gateway events handled", "event", self.events)
+        _render_counter(lines, "getwvkeysbot_event_errors_total", "Gateway event handlers that raised", "event", self.event_errors)
+        _render_histogram(lines, "getwvkeysbot_event_seconds", "Gateway event handling latency", "event", self.event_latency)
+        for name, (help, read) in sorted(self._gauges.items()):
+            try:
+                _render_gauge(lines, name, help, "kind", read())
+            except Exception as e:
+                logger.warning("[Metrics] Failed to read gauge {}: {}".format(name, e))
+        _render_gauge(lines, "getwvkeysbot_startup_seconds", "Seconds from process start to a startup milestone", "phase", self.startup)
+        lines.append("# TYPE getwvkeysbot_start_time_seconds gauge")
+        lines.append("getwvkeysbot_start_time_seconds {}".format(self.started_at))
+        return "\n".join(lines) + "\n"
+
+
+def _render_counter(lines: List[str], name: str, help: str, label: str, values: Dict[str, int]):
+    lines.append("# HELP {} {}".format(name, help))
+    lines.append("# TYPE {} counter".format(name))
+    for key, value in sorted(values.items()):
+        lines.append('{}{{{}="{}"}} {}'.format(name, label, key, value))
+
+
+def _render_gauge(lines: List[str], name: str, help: str, label: str, values: Dict[str, int]):
+    lines.append("# HELP {} {}".format(name, help))
+    lines.append("# TYPE {} gauge".format(name))
+    for key, value in sorted(values.items()):
+        lines.append('{}{{{}="{}"}} {}'.format(name, label, key, value))
+
+
+def _render_histogram(lines: List[str], name: str, help: str, label: str, histograms: Dict[str, Histogram]):
+    lines.append("# HELP {} {}".format(name, help))
+    lines.append("# TYPE {} histogram".format(name))
+    for key, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(name, label, key, bound, cumulative))
+        lines.append('{}_bucket{{{}="{}",le="+Inf"}} {}'.format(name, label, key, histogram.count))
+        lines.append('{}_sum{{{}="{}"}} {}'.format(name, label, key, histogram.sum))
+        lines.append('{}_count{{{}="{}"}} {}'.format(name, label, key, histogram.count))
+
+
+async def start_metrics_server():
+    # optional local scrape endpoint, disabled unless METRICS_PORT is set
+    if not METRICS_PORT:
+        return None
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info("[Metrics] Serving metrics on http://{}:{}/metrics".format(METRICS_HOST, METRICS_PORT))
+    return runner
+
+
+metrics = Metrics()
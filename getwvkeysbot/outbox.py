@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+import pathlib
+import sqlite3
+import time
+from typing import Dict, List, Optional, Set
+
+from getwvkeysbot.audit import AuditLog
+from getwvkeysbot.coalescer import IntentSuperseded, coalescer
+from getwvkeysbot.config import OUTBOX_BATCH_SIZE, OUTBOX_PATH, OUTBOX_RATE, OUTBOX_WAIT_TIMEOUT
+from getwvkeysbot.redis import IDEMPOTENT_OPS, STATE_OPS, APIError, APIQueued, APITimeout, APIUnavailable, OPCode, make_api_request
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    op INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    audit TEXT,
+    failure TEXT,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    done_at REAL,
+    error TEXT,
+    user_id INTEGER,
+    queued_at REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (done_at, next_attempt_at);
+"""
+
+# columns added after the first release, added to existing outboxes on start
+MIGRATIONS = {
+    "user_id": "ALTER TABLE outbox ADD COLUMN user_id INTEGER",
+    "queued_at": "ALTER TABLE outbox ADD COLUMN queued_at REAL",
+}
+
+# an entry is only sent once every earlier entry for the same user is done, so a user's changes
+# are applied in the order they were made even when an earlier one is waiting for a retry
+READY = """
+done_at IS NULL AND (
+    user_id IS NULL OR NOT EXISTS (SELECT 1 FROM outbox AS earlier WHERE earlier.user_id = outbox.user_id AND earlier.done_at IS NULL AND earlier.id < outbox.id)
+)
+"""
+
+# ops whose timeouts are retried, anything else may have been applied and is not sent again
+RETRY_ON_TIMEOUT = IDEMPOTENT_OPS | STATE_OPS
+
+# completed entries are kept this long for inspection
+RETENTION = 60 * 60 * 24 * 7
+
+
+class Outbox:
+    """
+    Durable on-disk queue for mutating API requests.
+
+    Entries are written to SQLite before they are sent, and a background drainer sends them at a
+    controlled rate, retrying transport failures with backoff. Entries for the same user are sent one
+    at a time in the order they were submitted, and an enable or disable submitted while the same one is
+    still pending for the user is merged into it. ``audit`` is posted to the log channel once an entry
+    succeeds or is queued by the API, ``failure`` is pinged if the API rejects it.
+    """
+
+    def __init__(self, audit: AuditLog, path: pathlib.Path = OUTBOX_PATH, rate: float = OUTBOX_RATE, batch_size: int = OUTBOX_BATCH_SIZE):
+        self.audit = audit
+        self.path = path
+        self.rate = rate
+        self.batch_size = batch_size
+        self.db: Optional[sqlite3.Connection] = None
+        self._waiters: Dict[int, List[asyncio.Future]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._drainer: Optional[asyncio.Task] = None
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # autocommit, WAL with synchronous=NORMAL keeps an insert in the tens of microseconds
+        self.db = sqlite3.connect(str(self.path), isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(outbox)")}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                self.db.execute(statement)
+        if "user_id" not in columns:
+            self.db.execute("UPDATE outbox SET user_id = json_extract(data, '$.user_id') WHERE done_at IS NULL")
+        self.db.execute("CREATE INDEX IF NOT EXISTS outbox_user ON outbox (user_id, done_at)")
+        self.db.execute("DELETE FROM outbox WHERE done_at IS NOT NULL AND done_at < ?", (time.time() - RETENTION,))
+
+    def start(self):
+        # opened here rather than on construction, so a clustered process can point ``path`` at its own file first
+        if self.db is None:
+            self._open()
+        if self._drainer is None or self._drainer.done():
+            self._wakeup = asyncio.Event()
+            self._drainer = asyncio.create_task(self._drain())
+
+    def submit(self, action: OPCode, data: dict, audit: Optional[str] = None, failure: Optional[str] = None) -> int:
+        user_id = data.get("user_id")
+        if user_id is not None and action in (OPCode.DISABLE_USER, OPCode.ENABLE_USER):
+            row = self.db.execute("SELECT id, op FROM outbox WHERE user_id = ? AND done_at IS NULL ORDER BY id DESC LIMIT 1", (user_id,)).fetchone()
+            if row is not None and row[1] == action.value:
+                # the same change is already waiting for this user, e.g. a ban also fires member_remove, so the
+                # caller shares that entry instead of sending it twice
+                return row[0]
+        cursor = self.db.execute(
+            "INSERT INTO outbox (op, data, audit, failure, created_at, user_id) VALUES (?, ?, ?, ?, ?, ?)",
+            (action.value, json.dumps(data), audit, failure, time.time(), user_id),
+        )
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return cursor.lastrowid
+
+    def wait(self, entry_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(entry_id, []).append(future)
+        return future
+
+    async def submit_and_wait(self, action: OPCode, data: dict, audit: Optional[str] = None, timeout: float = OUTBOX_WAIT_TIMEOUT):
+        future = self.wait(self.submit(action, data, audit))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # the entry is still stored and will be sent once the backend catches up
+            raise APIQueued()
+
+    def users_changed_since(self, since: float) -> Set[int]:
+        # users with an enable or disable submitted after ``since``
+        rows = self.db.execute("SELECT DISTINCT user_id FROM outbox WHERE created_at >= ? AND op IN (?, ?) AND user_id IS NOT NULL", (since, OPCode.DISABLE_USER.value, OPCode.ENABLE_USER.value))
+        return {row[0] for row in rows}
+
+    def pending(self) -> int:
+        if self.db is None:
+            return 0
+        return self.db.execute("SELECT COUNT(*) FROM outbox WHERE done_at IS NULL").fetchone()[0]
+
+    async def _drain(self):
+        while True:
+            try:
+                await self._drain_batch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("[Outbox] Drainer failed, retrying", exc_info=e)
+                await asyncio.sleep(5)
+
+    async def _drain_batch(self):
+        rows = self.db.execute(
+            "SELECT id, op, data, audit, failure, attempts FROM outbox WHERE {} AND next_attempt_at <= ? ORDER BY id LIMIT ?".format(READY),
+            (time.time(), self.batch_size),
+        ).fetchall()
+        if not rows:
+            return await self._sleep_until_next()
+
+        start = time.monotonic()
+        # a batch holds at most one entry per user, so they can be sent concurrently and disables in
+        # the same batch are merged by the coalescer
+        await asyncio.gather(*[self._send(*row) for row in rows])
+        # stay within the configured rate
+        await asyncio.sleep(max(0.0, len(rows) / self.rate - (time.monotonic() - start)))
+
+    async def _sleep_until_next(self):
+        row = self.db.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE {}".format(READY)).fetchone()
+        timeout = max(0.0, row[0] - time.time()) if row[0] is not None else None
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _send(self, entry_id: int, op: int, data: str, audit: Optional[str], failure: Optional[str], attempts: int):
+        action = OPCode(op)
+        payload = json.loads(data)
+        try:
+            if action == OPCode.DISABLE_USER:
+                result = await coalescer.disable(payload["user_id"])
+            elif action == OPCode.ENABLE_USER:
+                result = await coalescer.enable(payload["user_id"])
+            else:
+                result = await make_api_request(action, payload)
+        except IntentSuperseded as e:
+            # a later change for the same user replaced this one before it was sent, so it was never applied
+            logger.info("[Outbox] {} #{} was superseded: {}".format(action.name, entry_id, e))
+            self.db.execute("UPDATE outbox SET attempts = attempts + 1, done_at = ?, error = ? WHERE id = ?", (time.time(), str(e), entry_id))
+            self._resolve(entry_id, exception=e)
+            return
+        except APIQueued as e:
+            # the stream transport has the request durably, the API applies it once it is back
+            logger.info("[Outbox] {} #{} was queued by the API".format(action.name, entry_id))
+            self.db.execute("UPDATE outbox SET attempts = attempts + 1, done_at = ?, queued_at = ?, error = NULL WHERE id = ?", (time.time(), time.time(), entry_id))
+            if audit:
+                self.audit.log("{} (queued, the API applies it once it is back)".format(audit))
+            self._resolve(entry_id, exception=e)
+            return
+        except APITimeout as e:
+            if action not in RETRY_ON_TIMEOUT:
+                # the API may have applied it without replying in time, sending it again could apply it twice
+                return await self._reject(entry_id, action, failure, APITimeout("{}, it may or may not have been applied".format(e)))
+            self._retry(entry_id, action, attempts, e)
+            return
+        except (APIUnavailable, OSError) as e:
+            self._retry(entry_id, action, attempts, e)
+            return
+        except Exception as e:
+            # the API rejected the request, retrying won't help
+            return await self._reject(entry_id, action, failure, e)
+
+        self.db.execute("UPDATE outbox SET attempts = attempts + 1, done_at = ?, error = NULL WHERE id = ?", (time.time(), entry_id))
+        if audit:
+            self.audit.log(audit)
+        self._resolve(entry_id, result=result)
+
+    def _retry(self, entry_id: int, action: OPCode, attempts: int, e: Exception):
+        delay = min(300, 2**attempts)
+        logger.warning("[Outbox] {} #{} failed ({}), retrying in {}s".format(action.name, entry_id, e, delay))
+        self.db.execute("UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, error = ? WHERE id = ?", (time.time() + delay, str(e), entry_id))
+
+    async def _reject(self, entry_id: int, action: OPCode, failure: Optional[str], e: Exception):
+        logger.error("[Outbox] Giving up on {} #{}: {}".format(action.name, entry_id, e))
+        self.db.execute("UPDATE outbox SET attempts = attempts + 1, done_at = ?, error = ? WHERE id = ?", (time.time(), str(e), entry_id))
+        if failure:
+            try:
+                await self.audit.urgent(failure)
+            except Exception as send_error:
+                logger.exception("[Outbox] Failed to report a rejected entry", exc_info=send_error)
+        self._resolve(entry_id, exception=e if isinstance(e, APIError) else APIError(str(e)))
+
+    def _resolve(self, entry_id: int, result=None, exception: Optional[Exception] = None):
+        for future in self._waiters.pop(entry_id, []):
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
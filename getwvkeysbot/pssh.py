@@ -0,0 +1,178 @@
+import base64
+import binascii
+import re
+import struct
+import uuid
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+WIDEVINE_SYSTEM_ID = uuid.UUID("edef8ba9-79d6-4ace-a3c8-27dcd51d21ed")
+
+# WidevinePsshData.key_id
+WIDEVINE_KEY_ID_FIELD = 2
+
+KID_RE = re.compile(r"^\{?([0-9a-fA-F]{8})-?([0-9a-fA-F]{4})-?([0-9a-fA-F]{4})-?([0-9a-fA-F]{4})-?([0-9a-fA-F]{12})\}?$")
+
+
+class PSSHBox(NamedTuple):
+    version: int
+    system_id: uuid.UUID
+    kids: List[str]
+    data: bytes
+
+
+class SearchQuery(NamedTuple):
+    # normalized kids to look up, and the pssh to send as is when no kids could be extracted from it
+    kids: List[str]
+    pssh: Optional[str]
+
+
+def normalize_kid(value: str) -> Optional[str]:
+    # hex and uuid kids, with or without dashes and braces, as lowercase hex
+    match = KID_RE.match(value.strip())
+    if match is None:
+        return None
+    return "".join(match.groups()).lower()
+
+
+def _decode_base64(value: str) -> bytes:
+    # standard and url-safe base64, with or without padding
+    padded = value + "=" * (-len(value) % 4)
+    return base64.b64decode(padded.replace("-", "+").replace("_", "/"), validate=True)
+
+
+def normalize_search_query(query: str) -> str:
+    # the cache key of a query, kids as lowercase hex and anything else base64 as canonical base64
+    query = query.strip()
+    kid = normalize_kid(query)
+    if kid is not None:
+        return kid
+    try:
+        return base64.b64encode(_decode_base64(query)).decode()
+    except (binascii.Error, ValueError):
+        return query
+
+
+def _read_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data) or shift > 63:
+            raise ValueError("Truncated varint")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def _protobuf_fields(data: bytes) -> Iterator[Tuple[int, object]]:
+    offset = 0
+    while offset < len(data):
+        tag, offset = _read_varint(data, offset)
+        field, wire_type = tag >> 3, tag & 7
+        if field == 0:
+            raise ValueError("Invalid field number")
+        if wire_type == 0:
+            value, offset = _read_varint(data, offset)
+        elif wire_type == 1:
+            value, offset = data[offset : offset + 8], offset + 8
+        elif wire_type == 2:
+            length, offset = _read_varint(data, offset)
+            value, offset = data[offset : offset + length], offset + length
+        elif wire_type == 5:
+            value, offset = data[offset : offset + 4], offset + 4
+        else:
+            raise ValueError("Unsupported wire type {}".format(wire_type))
+        if offset > len(data):
+            raise ValueError("Truncated field")
+        yield field, value
+
+
+def widevine_kids(data: bytes) -> List[str]:
+    # key ids from a serialized WidevinePsshData message
+    return [value.hex() for field, value in _protobuf_fields(data) if field == WIDEVINE_KEY_ID_FIELD and isinstance(value, bytes) and len(value) == 16]
+
+
+def parse_pssh_boxes(data: bytes) -> List[PSSHBox]:
+    # one or more concatenated pssh boxes, as found in init data
+    boxes = []
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < 32:
+            raise ValueError("Truncated pssh box")
+        size, box_type, version_flags = struct.unpack_from(">I4sI", data, offset)
+        if box_type != b"pssh" or size < 32 or offset + size > len(data):
+            raise ValueError("Not a pssh box")
+        version = version_flags >> 24
+        if version > 1:
+            raise ValueError("Unsupported pssh box version {}".format(version))
+        box = data[offset : offset + size]
+        system_id = uuid.UUID(bytes=box[12:28])
+        position = 28
+        kids = []
+        if version == 1:
+            (count,) = struct.unpack_from(">I", box, position)
+            position += 4
+            if position + count * 16 + 4 > size:
+                raise ValueError("Truncated pssh key ids")
+            kids = [box[position + i * 16 : position + (i + 1) * 16].hex() for i in range(count)]
+            position += count * 16
+        (data_size,) = struct.unpack_from(">I", box, position)
+        position += 4
+        if position + data_size != size:
+            raise ValueError("pssh data size doesn't match the box size")
+        boxes.append(PSSHBox(version, system_id, kids, box[position:]))
+        offset += size
+    return boxes
+
+
+def _unique(values: List[str]) -> List[str]:
+    return list(dict.fromkeys(values))
+
+
+def parse_search_query(query: str) -> SearchQuery:
+    """
+    Validates a search query without asking the API.
+
+    Accepts hex or uuid kids, base64 kids, base64 pssh boxes and base64 WidevinePsshData. Kids are
+    taken from v1 box headers and from Widevine data. Raises ValueError for anything else.
+    """
+    query = query.strip()
+    kid = normalize_kid(query)
+    if kid is not None:
+        return SearchQuery([kid], None)
+
+    try:
+        data = _decode_base64(query)
+    except (binascii.Error, ValueError):
+        raise ValueError("Not a kid or base64 pssh")
+    if not data:
+        raise ValueError("Empty query")
+    if len(data) == 16:
+        return SearchQuery([data.hex()], None)
+
+    try:
+        boxes = parse_pssh_boxes(data)
+    except (ValueError, struct.error):
+        # some players only expose the data part of a widevine pssh
+        try:
+            kids = widevine_kids(data)
+        except ValueError:
+            raise ValueError("Not a pssh box")
+        if not kids:
+            raise ValueError("Not a pssh box")
+        return SearchQuery(_unique(kids), None)
+
+    kids = []
+    for box in boxes:
+        kids.extend(box.kids)
+        if box.system_id == WIDEVINE_SYSTEM_ID:
+            try:
+                kids.extend(widevine_kids(box.data))
+            except ValueError:
+                pass
+    if not kids:
+        # a valid box without key ids, let the API resolve it
+        return SearchQuery([], base64.b64encode(data).decode())
+    return SearchQuery(_unique(kids), None)
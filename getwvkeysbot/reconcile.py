@@ -0,0 +1,80 @@
+import logging
+import struct
+import time
+from typing import Iterable, Set, Tuple
+
+import discord
+
+from getwvkeysbot.outbox import Outbox
+from getwvkeysbot.redis import OPCode, raw_redis_cli
+from getwvkeysbot.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+def pack_ids(ids: Iterable[int]) -> bytes:
+    # sorted little-endian uint64s, 8 bytes per snowflake
+    ordered = sorted(ids)
+    return struct.pack("<{}Q".format(len(ordered)), *ordered)
+
+
+def unpack_ids(data: bytes) -> Set[int]:
+    return set(struct.unpack("<{}Q".format(len(data) // 8), data))
+
+
+async def collect_verified_members(guild: discord.Guild) -> Set[int]:
+    if guild.chunked:
+        return {member.id for member in guild.members if not member.bot and settings.verified_role in member._roles}
+    # without a full member cache, page through the member list over REST instead
+    verified = set()
+    async for member in guild.fetch_members(limit=None):
+        if not member.bot and settings.verified_role in member._roles:
+            verified.add(member.id)
+    return verified
+
+
+class VerifiedReconciler:
+    """
+    Keeps the API's enabled accounts in line with the members holding the verified role.
+
+    The verified member ids from the last run are stored in Redis, and each run only sends the
+    difference, so catching up after downtime costs work proportional to what changed. The changes go
+    through the outbox like the ones from member events, so they are ordered with them per user.
+    """
+
+    def __init__(self, redis_cli=raw_redis_cli):
+        self.redis = redis_cli
+
+    @staticmethod
+    def snapshot_key(guild_id: int) -> str:
+        return "verified:{}:snapshot".format(guild_id)
+
+    async def reconcile(self, guild: discord.Guild, outbox: Outbox) -> Tuple[int, int]:
+        key = self.snapshot_key(guild.id)
+        data = await self.redis.get(key)
+        started = time.time()
+        current = await collect_verified_members(guild)
+        if data is None:
+            # nothing to diff against yet, the events keep things in sync until the next run
+            await self.redis.set(key, pack_ids(current))
+            logger.info("[Reconcile] Stored a baseline of {} verified members for {}".format(len(current), guild.id))
+            return 0, 0
+
+        previous = unpack_ids(data)
+        # a member event submitted while the members were collected is newer than what was collected, so
+        # those users keep their previous snapshot state and the next run looks at them again
+        skipped = outbox.users_changed_since(started)
+        enabled = current - previous - skipped
+        disabled = previous - current - skipped
+
+        for user_id in sorted(disabled):
+            outbox.submit(OPCode.DISABLE_USER, {"user_id": user_id})
+        for user_id in sorted(enabled):
+            outbox.submit(OPCode.ENABLE_USER, {"user_id": user_id})
+
+        await self.redis.set(key, pack_ids((current - skipped) | (previous & skipped)))
+        logger.info("[Reconcile] Submitted {} enables and {} disables for {}".format(len(enabled), len(disabled), guild.id))
+        return len(enabled), len(disabled)
+
+
+reconciler = VerifiedReconciler()
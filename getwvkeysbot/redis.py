@@ -1,11 +1,34 @@
-from enum import Enum
+import asyncio
 import json
 import logging
 import random
-import redis
+import time
+import uuid
+from collections import OrderedDict
+from enum import Enum
+from typing import Callable, Dict, Optional, Union
 
-from getwvkeysbot.config import REDIS_URI
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError, ResponseError
 
+from getwvkeysbot.codec import PayloadCodec, decode
+from getwvkeysbot.config import (
+    API_BREAKER_RESET_TIMEOUT,
+    API_BREAKER_THRESHOLD,
+    API_CAPABILITIES_KEY,
+    API_CAPABILITIES_REFRESH,
+    API_DEFAULT_DEADLINE,
+    API_MAX_RETRIES,
+    API_RETRY_BACKOFF,
+    API_STREAM,
+    API_STREAM_DEADLINE,
+    API_STREAM_GROUP,
+    API_STREAM_MAXLEN,
+    API_TRANSPORT,
+    CLUSTER_NODE_ID,
+    REDIS_URI,
+)
+from getwvkeysbot.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -24,45 +47,371 @@ class OPCode(Enum):
     RESET_API_KEY = 9
 
 
-redis_cli = redis.Redis.from_url(REDIS_URI, decode_responses=True, encoding="utf8")
+# seconds to wait for a reply before giving up, ops not listed here use API_DEFAULT_DEADLINE
+OP_DEADLINES = {
+    OPCode.KEY_COUNT: 10,
+    OPCode.USER_COUNT: 10,
+    OPCode.SEARCH: 10,
+    OPCode.DISABLE_USER_BULK: 60,
+}
+
+# ops that are safe to send again when a reply doesn't arrive in time
+IDEMPOTENT_OPS = frozenset([OPCode.KEY_COUNT, OPCode.USER_COUNT, OPCode.SEARCH])
+
+# ops that set a user's state, applying one twice is the same as applying it once. The outbox resends
+# them after a timeout, the client doesn't retry them itself so a caller is not held for several deadlines
+STATE_OPS = frozenset([OPCode.DISABLE_USER, OPCode.DISABLE_USER_BULK, OPCode.ENABLE_USER])
+
+# ops that change state, these must not be lost while the API is restarting
+MODERATION_OPS = frozenset([OPCode.DISABLE_USER, OPCode.DISABLE_USER_BULK, OPCode.ENABLE_USER, OPCode.UPDATE_PERMISSIONS, OPCode.QUARANTINE, OPCode.RESET_API_KEY])
+
+
+class APIError(Exception):
+    pass
+
+
+class APITimeout(APIError):
+    pass
+
+
+class APIQueued(APITimeout):
+    def __init__(self, message: str = "The request was queued but the backend has not processed it yet, it will be applied once the backend is back."):
+        super().__init__(message)
+
+
+class APIUnavailable(APIError):
+    def __init__(self, message: str = "The backend is currently unavailable, please try again later."):
+        super().__init__(message)
+
+
+class CircuitBreaker:
+    """
+    Fails requests fast while the API is unreachable.
+
+    Opens after ``threshold`` consecutive transport failures. Once ``reset_timeout`` seconds have
+    passed a single trial request is let through, which closes the breaker again if it succeeds.
+    """
+
+    def __init__(self, threshold: int = API_BREAKER_THRESHOLD, reset_timeout: float = API_BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self._trial_at is not None else "open"
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_timeout:
+            raise APIUnavailable()
+        # only one trial at a time, a trial that never finished is given up on after another reset_timeout
+        if self._trial_at is not None and now - self._trial_at < self.reset_timeout:
+            raise APIUnavailable()
+        self._trial_at = now
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_at = None
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning("[Redis] API unreachable after {} failures, failing requests fast".format(self.failures))
+            self.opened_at = time.monotonic()
 
-p = redis_cli.pubsub(ignore_subscribe_messages=True)
 
+def _text(value: Union[str, bytes]) -> str:
+    return value.decode() if isinstance(value, bytes) else value
 
-# def redis_message_handler(msg):
-#     try:
-#         data = json.loads(msg.get("data"))
-#         op = data.get("op")
-#         d = data.get("d")
 
-#         if not op in OPCode:
-#             r = {"op": -1, "d": "Invalid OP code"}
-#             redis_cli.publish("api", json.dumps(r))
-#             return
+class APIClient:
+    """
+    asyncio request/reply client for the API.
 
-#         print("Recieved OP Code {}".format(op))
+    Every request gets a unique correlation id and is answered on ``<reply_prefix>:<correlation id>``.
+    A single pattern subscription on ``<reply_prefix>:*`` receives all replies for this process and
+    resolves the matching future, so any number of requests can be in flight at once.
 
-#     except json.JSONDecodeError as e:
-#         print(e)
+    Ops in ``stream_ops`` are appended to a Redis Stream instead, which the API consumes through a
+    consumer group and acks, so they survive API restarts. Their replies are added to this process'
+    reply stream tagged with the request's stream message id.
 
+    Payloads are encoded with the format the API advertises under ``API_CAPABILITIES_KEY``, falling
+    back to plain JSON, unless a ``codec`` is given. Replies may be binary, so ``redis_cli`` should
+    not decode responses.
+    """
 
-# p.subscribe(**{"bot": redis_message_handler})
-# redis_thread = p.run_in_thread(daemon=True)
+    def __init__(
+        self,
+        redis_cli: aioredis.Redis,
+        request_channel: str = "api",
+        stream_ops: frozenset = frozenset(),
+        request_stream: str = API_STREAM,
+        codec: Optional[PayloadCodec] = None,
+    ):
+        self.redis = redis_cli
+        self.codec = codec or PayloadCodec()
+        self._negotiate = codec is None
+        # what the API advertised in API_CAPABILITIES_KEY, also used to enable optional request forms
+        self.capabilities: dict = {}
+        self._capabilities_checked_at = 0.0
+        self._capabilities_task: Optional[asyncio.Task] = None
+        self.request_channel = request_channel
+        self.stream_ops = stream_ops
+        self.request_stream = request_stream
+        # replies are routed back to the process that sent the request
+        self.reply_prefix = "bot-{}-{}".format(CLUSTER_NODE_ID, uuid.uuid4().hex[:8])
+        self.reply_stream = self.reply_prefix + ":replies"
+        self._pending: Dict[str, asyncio.Future] = {}
+        # stream message id -> future, and replies that arrived before their future was registered
+        self._stream_pending: Dict[str, asyncio.Future] = {}
+        self._early_replies: "OrderedDict[str, bytes]" = OrderedDict()
+        self._stream_listener: Optional[asyncio.Task] = None
+        # extra channels the API publishes notifications on, channel -> handler
+        self._handlers: Dict[str, Callable[[str], None]] = {}
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+        self._start_lock: Optional[asyncio.Lock] = None
+        self.breaker = CircuitBreaker()
 
+    async def start(self):
+        if self._listener is not None:
+            return
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._listener is not None:
+                return
+            if self._negotiate:
+                await self.refresh_capabilities()
+            self._pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            await self._pubsub.psubscribe(self.reply_prefix + ":*")
+            if self._handlers:
+                await self._pubsub.subscribe(*self._handlers)
+            if self.stream_ops:
+                await self._ensure_stream_group()
+                self._stream_listener = asyncio.create_task(self._listen_stream())
+                logger.info("[Redis] Sending {} through stream {}".format(", ".join(sorted(op.name for op in self.stream_ops)), self.request_stream))
+            self._listener = asyncio.create_task(self._listen())
+            logger.info("[Redis] Listening for replies on {}:*".format(self.reply_prefix))
 
-def make_api_request(action: OPCode, data={}):
-    reply_address = "api-" + str(random.randint(1000, 9999))
-    p.subscribe(reply_address)
-    payload = {"op": action.value, "d": data, "reply_to": reply_address}
+    async def refresh_capabilities(self):
+        self._capabilities_checked_at = time.monotonic()
+        try:
+            data = await self.redis.get(API_CAPABILITIES_KEY)
+            capabilities = json.loads(data) if data else {}
+            codec = PayloadCodec.negotiate(capabilities)
+        except (RedisError, ValueError, AttributeError) as e:
+            logger.warning("[Redis] Failed to read the API capabilities, keeping {}: {}".format(self.codec.name, e))
+            return
+        if codec.name != self.codec.name:
+            logger.info("[Redis] Encoding API payloads as {}".format(codec.name))
+        self.codec = codec
+        self.capabilities = capabilities
 
-    redis_cli.publish("api", json.dumps(payload))
-    for message in p.listen():
-        logger.debug(message)
-        if message["type"] == "message":
-            p.unsubscribe(reply_address)
-            rd = json.loads(message["data"])
+    def _maybe_refresh_capabilities(self):
+        # picks up API upgrades and downgrades without a restart
+        if not self._negotiate or time.monotonic() - self._capabilities_checked_at < API_CAPABILITIES_REFRESH:
+            return
+        if self._capabilities_task is None or self._capabilities_task.done():
+            self._capabilities_task = asyncio.create_task(self.refresh_capabilities())
+
+    async def _ensure_stream_group(self):
+        # create the API's consumer group up front, so requests added while the API is down wait for it
+        try:
+            await self.redis.xgroup_create(self.request_stream, API_STREAM_GROUP, id="$", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def subscribe(self, channel: str, handler: Callable[[str], None]):
+        self._handlers[channel] = handler
+        if self._pubsub is not None:
+            await self._pubsub.subscribe(channel)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self._stream_listener is not None:
+            self._stream_listener.cancel()
+            self._stream_listener = None
+        if self._pubsub is not None:
+            await self._pubsub.punsubscribe()
+            await self._pubsub.close()
+            self._pubsub = None
+        for future in [*self._pending.values(), *self._stream_pending.values()]:
+            if not future.done():
+                future.set_exception(APIError("API client was closed"))
+        self._pending.clear()
+        self._stream_pending.clear()
+
+    async def _listen(self):
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message["type"] == "pmessage":
+                        self._handle_reply(_text(message["channel"]), message["data"])
+                    elif message["type"] == "message":
+                        self._handle_notification(_text(message["channel"]), _text(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("[Redis] Reply listener failed, resubscribing", exc_info=e)
+                await asyncio.sleep(1)
+
+    async def _listen_stream(self):
+        # the reply stream is unique to this process, so read it from the start
+        last_id = "0-0"
+        while True:
+            try:
+                result = await self.redis.xread({self.reply_stream: last_id}, count=500, block=5000)
+                ids = []
+                for _, entries in result or []:
+                    for entry_id, fields in entries:
+                        last_id = entry_id
+                        ids.append(entry_id)
+                        fields = {_text(key): value for key, value in fields.items()}
+                        self._handle_stream_reply(_text(fields["id"]), fields["payload"])
+                if ids:
+                    await self.redis.xdel(self.reply_stream, *ids)
+                    # let the reply stream of a process that went away expire on its own
+                    await self.redis.expire(self.reply_stream, 60 * 60 * 24)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("[Redis] Reply stream listener failed, retrying", exc_info=e)
+                await asyncio.sleep(1)
+
+    def _handle_stream_reply(self, message_id: str, data: bytes):
+        future = self._stream_pending.get(message_id)
+        if future is None:
+            # the reply beat the request's bookkeeping, keep it around briefly
+            self._early_replies[message_id] = data
+            while len(self._early_replies) > 1000:
+                self._early_replies.popitem(last=False)
+            return
+        if not future.done():
+            self._resolve(future, data)
+
+    def _handle_reply(self, channel: str, data: bytes):
+        correlation_id = channel.rsplit(":", 1)[-1]
+        future = self._pending.get(correlation_id)
+        if future is None or future.done():
+            logger.debug("[Redis] Dropping reply for unknown request {}".format(correlation_id))
+            return
+        self._resolve(future, data)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, data: bytes):
+        try:
+            rd = decode(data)
             rmsg = rd["d"]["message"]
-            rop = rd["op"]
-            if rop == OPCode.ERROR.value:
-                raise Exception(rmsg)
-            return rmsg
+            if rd["op"] == OPCode.ERROR.value:
+                future.set_exception(APIError(rmsg))
+            else:
+                future.set_result(rmsg)
+        except Exception as e:
+            future.set_exception(e)
+
+    def _handle_notification(self, channel: str, data: str):
+        handler = self._handlers.get(channel)
+        if handler is None:
+            return
+        try:
+            handler(data)
+        except Exception as e:
+            logger.exception("[Redis] Handler for {} failed".format(channel), exc_info=e)
+
+    async def request(self, action: OPCode, data: Optional[dict] = None):
+        self._maybe_refresh_capabilities()
+        with metrics.track_request(action.name):
+            return await self._request_with_retries(action, data)
+
+    async def _request_with_retries(self, action: OPCode, data: Optional[dict]):
+        if action in self.stream_ops:
+            # stream requests are durable, so they are neither retried nor failed fast by the breaker
+            return await self._stream_request(action, data, API_STREAM_DEADLINE)
+        attempts = 1 + (API_MAX_RETRIES if action in IDEMPOTENT_OPS else 0)
+        deadline = OP_DEADLINES.get(action, API_DEFAULT_DEADLINE)
+        for attempt in range(attempts):
+            self.breaker.check()
+            try:
+                result = await self._request_once(action, data, deadline)
+            except (APITimeout, RedisError) as e:
+                self.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    if isinstance(e, RedisError):
+                        raise APIUnavailable() from e
+                    raise
+                # full jitter so retries from many callers don't arrive in lockstep
+                delay = random.uniform(0, API_RETRY_BACKOFF * 2**attempt)
+                logger.warning("[Redis] {} attempt {} failed ({}), retrying in {:.2f}s".format(action.name, attempt + 1, e, delay))
+                await asyncio.sleep(delay)
+            except APIError:
+                # the API answered, so it is reachable
+                self.breaker.record_success()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def _request_once(self, action: OPCode, data: Optional[dict], deadline: float):
+        await self.start()
+        correlation_id = uuid.uuid4().hex
+        reply_address = "{}:{}".format(self.reply_prefix, correlation_id)
+        payload = {"op": action.value, "d": data or {}, "reply_to": reply_address, "id": correlation_id}
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[correlation_id] = future
+        try:
+            receivers = await self.redis.publish(self.request_channel, self.codec.encode(payload))
+            if receivers == 0:
+                raise APITimeout("No API instance is listening for requests")
+            return await asyncio.wait_for(future, deadline)
+        except asyncio.TimeoutError:
+            raise APITimeout("The backend did not respond to {} within {}s".format(action.name, deadline))
+        finally:
+            self._pending.pop(correlation_id, None)
+
+    async def _stream_request(self, action: OPCode, data: Optional[dict], deadline: float):
+        await self.start()
+        payload = {"op": action.value, "d": data or {}, "reply_to": self.reply_stream}
+        try:
+            message_id = _text(await self.redis.xadd(self.request_stream, {"payload": self.codec.encode(payload)}, maxlen=API_STREAM_MAXLEN, approximate=True))
+        except RedisError as e:
+            raise APIUnavailable() from e
+
+        future = asyncio.get_running_loop().create_future()
+        early = self._early_replies.pop(message_id, None)
+        if early is not None:
+            self._resolve(future, early)
+        else:
+            self._stream_pending[message_id] = future
+        try:
+            return await asyncio.wait_for(future, deadline)
+        except asyncio.TimeoutError:
+            raise APIQueued()
+        finally:
+            self._stream_pending.pop(message_id, None)
+
+
+redis_cli = aioredis.Redis.from_url(REDIS_URI, decode_responses=True, encoding="utf8")
+# for binary values, replies are returned as bytes
+raw_redis_cli = aioredis.Redis.from_url(REDIS_URI)
+
+api = APIClient(raw_redis_cli, stream_ops=MODERATION_OPS if API_TRANSPORT == "streams" else frozenset())
+
+
+async def make_api_request(action: OPCode, data: Optional[dict] = None):
+    return await api.request(action, data)
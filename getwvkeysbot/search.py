@@ -0,0 +1,156 @@
+import io
+import logging
+import math
+from typing import List, NamedTuple, Optional
+
+import discord
+
+from getwvkeysbot.cache import search_cache
+from getwvkeysbot.config import SEARCH_FILE_PAGE_SIZE, SEARCH_PAGE_SIZE
+from getwvkeysbot.pssh import parse_search_query
+
+logger = logging.getLogger(__name__)
+
+# discord rejects embed field values and titles longer than this
+FIELD_VALUE_LIMIT = 1024
+TITLE_LIMIT = 256
+
+
+class SearchPage(NamedTuple):
+    kid: Optional[str]
+    keys: List[dict]
+    offset: int
+    total: int
+
+
+async def fetch_page(query: str, offset: int, limit: int) -> Optional[SearchPage]:
+    # the query has been validated by the caller, parse_search_query raises ValueError otherwise
+    parsed = parse_search_query(query)
+    if len(parsed.kids) > 1:
+        return await fetch_merged_page(parsed.kids, offset, limit)
+    results = await search_cache.search(parsed.kids[0] if parsed.kids else parsed.pssh, offset, limit)
+    if not results:
+        return None
+    keys = results.get("keys") or []
+    total = results.get("total")
+    if total is None:
+        # older API versions ignore offset/limit and return every key, page locally instead
+        total = len(keys)
+        keys = keys[offset : offset + limit]
+    return SearchPage(results.get("kid"), keys, offset, total)
+
+
+async def fetch_merged_page(kids: List[str], offset: int, limit: int) -> Optional[SearchPage]:
+    # a pssh with several kids, looked up together and merged into one result list
+    results = await search_cache.search_many(kids)
+    if all(result is None for result in results.values()):
+        return None
+    keys = {}
+    for kid in kids:
+        for key_entry in (results.get(kid) or {}).get("keys") or []:
+            keys.setdefault(key_entry.get("key"), key_entry)
+    merged = list(keys.values())
+    return SearchPage(None, merged[offset : offset + limit], offset, len(merged))
+
+
+def build_embed(query: str, page: SearchPage, page_size: int = SEARCH_PAGE_SIZE) -> discord.Embed:
+    if len(query) > TITLE_LIMIT - 24:
+        query = query[: TITLE_LIMIT - 27] + "..."
+    embed = discord.Embed(title="Search Results for '{}'".format(query), description="Found **{}** result{}".format(page.total, "s" if page.total != 1 else ""))
+
+    lines = []
+    length = 0
+    for key_entry in page.keys:
+        line = key_entry.get("key")
+        # +1 for the newline joining the lines
+        if not lines and len(line) > FIELD_VALUE_LIMIT:
+            # a single key longer than a field would leave the page empty, show its start, the file has all of it
+            line = line[: FIELD_VALUE_LIMIT - 4] + "..."
+        if length + len(line) + 1 > FIELD_VALUE_LIMIT:
+            logger.warning("Search page would exceed {} characters. KID: {}".format(FIELD_VALUE_LIMIT, page.kid))
+            break
+        lines.append(line)
+        length += len(line) + 1
+
+    embed.add_field(name="Results", value="\n".join(lines), inline=False)
+
+    footer = "Page {}/{}".format(page.offset // page_size + 1, max(1, math.ceil(page.total / page_size)))
+    if len(lines) < len(page.keys):
+        footer += " - {} keys on this page were omitted".format(len(page.keys) - len(lines))
+    embed.set_footer(text=footer)
+    return embed
+
+
+async def build_results_file(query: str, kid: Optional[str]) -> discord.File:
+    # fetch the full result set in large pages instead of one huge reply
+    buffer = io.BytesIO()
+    offset = 0
+    while True:
+        page = await fetch_page(query, offset, SEARCH_FILE_PAGE_SIZE)
+        if page is None or not page.keys:
+            break
+        buffer.write("".join("{}\n".format(key_entry.get("key")) for key_entry in page.keys).encode())
+        offset += len(page.keys)
+        if offset >= page.total:
+            break
+    buffer.seek(0)
+    return discord.File(buffer, filename="{}.txt".format(kid or "results"))
+
+
+class SearchPaginator(discord.ui.View):
+    def __init__(self, author_id: int, query: str, page: SearchPage, page_size: int = SEARCH_PAGE_SIZE):
+        super().__init__(timeout=300)
+        self.author_id = author_id
+        self.query = query
+        self.page = page
+        self.page_size = page_size
+        self.message: Optional[discord.Message] = None
+        self._update_buttons()
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page.offset == 0
+        self.next_page.disabled = self.page.offset + self.page_size >= self.page.total
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("Only the person who searched can use these buttons.", ephemeral=True)
+            return False
+        return True
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+    async def _show(self, interaction: discord.Interaction, offset: int):
+        # only fetch the requested page when someone actually asks for it
+        try:
+            page = await fetch_page(self.query, offset, self.page_size)
+        except Exception as e:
+            logger.exception(e)
+            return await interaction.response.send_message("An error occurred while searching: {}".format(e), ephemeral=True)
+        if page is None:
+            return await interaction.response.send_message("The response was null. Please report this to the developers.", ephemeral=True)
+        self.page = page
+        self._update_buttons()
+        await interaction.response.edit_message(embed=build_embed(self.query, page, self.page_size), view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, max(0, self.page.offset - self.page_size))
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page.offset + self.page_size)
+
+    @discord.ui.button(label="Download all", style=discord.ButtonStyle.primary)
+    async def download(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer(thinking=True)
+        try:
+            file = await build_results_file(self.query, self.page.kid)
+        except Exception as e:
+            logger.exception(e)
+            return await interaction.followup.send("An error occurred while searching: {}".format(e))
+        await interaction.followup.send(file=file)
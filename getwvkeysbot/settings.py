@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import re
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set
+
+from getwvkeysbot import config
+from getwvkeysbot.config import SETTINGS_CHANNEL, SETTINGS_KEY
+from getwvkeysbot.redis import api, redis_cli
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_id(value: str) -> int:
+    value = value.strip()
+    if not value.isdigit():
+        raise ValueError("{!r} is not an id".format(value))
+    return int(value)
+
+
+def _parse_ids(value: str) -> FrozenSet[int]:
+    return frozenset(_parse_id(part) for part in re.split(r"[\s,]+", value.strip()) if part)
+
+
+def _format(value) -> str:
+    if isinstance(value, frozenset):
+        return ",".join(str(item) for item in sorted(value))
+    return str(value)
+
+
+# setting name -> (parser, default from config.py)
+FIELDS = {
+    "log_channel_id": (_parse_id, config.LOG_CHANNEL_ID),
+    "interrogation_channel_id": (_parse_id, config.INTERROGATION_CHANNEL_ID),
+    "scripts_channel_id": (_parse_id, config.SCRIPTS_CHANNEL_ID),
+    "admin_users": (_parse_ids, frozenset(config.ADMIN_USERS)),
+    "admin_roles": (_parse_ids, frozenset(config.ADMIN_ROLES)),
+    "verified_role": (_parse_id, config.VERIFIED_ROLE),
+    "sus_role": (_parse_id, config.SUS_ROLE),
+    "script_dev_role_id": (_parse_id, config.SCRIPT_DEV_ROLE_ID),
+}
+
+
+class Settings:
+    """
+    Channel, role and admin ids that can be changed without a restart.
+
+    Defaults come from config.py and are overridden by the fields of the ``SETTINGS_KEY`` redis hash.
+    Every process reloads when anything is published on ``SETTINGS_CHANNEL``. A reload parses all
+    fields before applying any of them, so a bad value leaves the previous settings in place. Id
+    lists are kept as frozensets for the admin checks.
+    """
+
+    log_channel_id: int
+    interrogation_channel_id: int
+    scripts_channel_id: int
+    admin_users: FrozenSet[int]
+    admin_roles: FrozenSet[int]
+    verified_role: int
+    sus_role: int
+    script_dev_role_id: int
+
+    def __init__(self, redis_cli=redis_cli, key: str = SETTINGS_KEY, channel: str = SETTINGS_CHANNEL):
+        self.redis = redis_cli
+        self.key = key
+        self.channel = channel
+        self.overrides: Dict[str, str] = {}
+        self._listeners: List[Callable[[Set[str]], None]] = []
+        self._reload_task: Optional[asyncio.Task] = None
+        self._reload_pending = False
+        self._apply({name: default for name, (_, default) in FIELDS.items()})
+
+    def is_admin(self, user_id: int, role_ids: Iterable[int] = ()) -> bool:
+        return user_id in self.admin_users or not self.admin_roles.isdisjoint(role_ids)
+
+    def values(self) -> Dict[str, str]:
+        return {name: _format(getattr(self, name)) for name in FIELDS}
+
+    def add_listener(self, listener: Callable[[Set[str]], None]):
+        # called with the names of the settings that changed on each reload
+        self._listeners.append(listener)
+
+    @staticmethod
+    def parse(overrides: Dict[str, str]) -> Dict[str, object]:
+        values = {name: default for name, (_, default) in FIELDS.items()}
+        for name, value in overrides.items():
+            if name not in FIELDS:
+                logger.warning("[Settings] Ignoring unknown setting {}".format(name))
+                continue
+            try:
+                values[name] = FIELDS[name][0](value)
+            except ValueError as e:
+                raise ValueError("Invalid value for {}: {}".format(name, e))
+        return values
+
+    def _apply(self, values: Dict[str, object]) -> Set[str]:
+        changed = {name for name, value in values.items() if getattr(self, name, None) != value}
+        for name in changed:
+            setattr(self, name, values[name])
+        return changed
+
+    async def reload(self) -> Set[str]:
+        overrides = await self.redis.hgetall(self.key)
+        changed = self._apply(self.parse(overrides))
+        self.overrides = overrides
+        if changed:
+            logger.info("[Settings] Reloaded, changed {}".format(", ".join(sorted(changed))))
+            for listener in self._listeners:
+                try:
+                    listener(changed)
+                except Exception as e:
+                    logger.exception("[Settings] Reload listener failed", exc_info=e)
+        return changed
+
+    async def set(self, name: str, value: Optional[str]):
+        # stores an override, or removes it when value is None, and tells every process to reload
+        if name not in FIELDS:
+            raise ValueError("Unknown setting {}, valid settings are {}".format(name, ", ".join(FIELDS)))
+        if value is None:
+            await self.redis.hdel(self.key, name)
+        else:
+            self.parse({name: value})
+            await self.redis.hset(self.key, name, value)
+        await self.publish()
+
+    async def publish(self):
+        await self.redis.publish(self.channel, "reload")
+
+    async def start(self):
+        # subscribe first, so a change made while the hash is being read is not missed
+        await api.subscribe(self.channel, self._handle_reload)
+        try:
+            await self.reload()
+        except Exception as e:
+            logger.exception("[Settings] Failed to load the live settings, using the defaults", exc_info=e)
+
+    def _handle_reload(self, data: str):
+        # a reload requested while one is running runs again afterwards, so no change is missed
+        self._reload_pending = True
+        if self._reload_task is None or self._reload_task.done():
+            self._reload_task = asyncio.create_task(self._reload_loop())
+
+    async def _reload_loop(self):
+        while self._reload_pending:
+            self._reload_pending = False
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.exception("[Settings] Failed to reload the live settings", exc_info=e)
+
+
+settings = Settings()
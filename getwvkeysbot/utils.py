@@ -1,10 +1,25 @@
+import atexit
+import copy
+import json
 import logging
 import logging.handlers
+import pathlib
+import queue
+import re
 from enum import Enum
+from typing import Optional
 
 from coloredlogs import ColoredFormatter
 
-from getwvkeysbot.config import LOG_DATE_FORMAT, LOG_FILE_PATH, LOG_FORMAT, LOG_LEVEL
+from getwvkeysbot.config import (
+    LOG_BACKUP_COUNT,
+    LOG_DATE_FORMAT,
+    LOG_FILE_PATH,
+    LOG_FORMAT,
+    LOG_JSON_PATH,
+    LOG_LEVEL,
+    LOG_QUEUE_SIZE,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -23,8 +38,78 @@ class FlagAction(Enum):
     REMOVE = "remove"
 
 
+def parse_flags(text: str) -> int:
+    # flag names separated by commas, pipes or spaces, combined into one bitmask
+    value = 0
+    for name in re.split(r"[\s,|+]+", text.strip().upper()):
+        if not name:
+            continue
+        if name not in UserFlags._member_names_:
+            raise ValueError("Unknown user flag {}".format(name))
+        value |= UserFlags[name].value
+    if not value:
+        raise ValueError("No user flags given")
+    return value
+
+
+_traceback_formatter = logging.Formatter()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # never blocks the caller, records that don't fit in the queue are counted and dropped
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # unlike QueueHandler.prepare the traceback stays in exc_text instead of being merged into msg,
+        # so each listener handler still formats it its own way (the JSON one as a separate field)
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _traceback_formatter.formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        # tracebacks hold frames, which don't survive being queued to another process
+        record.exc_info = None
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "func": record.funcName,
+            "line": record.lineno,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        if record.stack_info:
+            entry["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, separators=(",", ":"))
+
+
+queue_handler: Optional[DroppingQueueHandler] = None
+
+
+def _daily_file_handler(path: pathlib.Path) -> logging.Handler:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return logging.handlers.TimedRotatingFileHandler(path, when="midnight", backupCount=LOG_BACKUP_COUNT, encoding="utf8")
+
+
 def construct_logger():
-    LOG_FILE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    global queue_handler
 
     # setup handlers
     # create a colored formatter for the console
@@ -35,13 +120,28 @@ def construct_logger():
     stream = logging.StreamHandler()
     stream.setLevel(LOG_LEVEL)
     stream.setFormatter(console_formatter)
-    # create a handler for file logging, 5 mb max size, with 5 backup files
-    file_handler = logging.handlers.RotatingFileHandler(LOG_FILE_PATH, maxBytes=(1024 * 1024) * 5, backupCount=5)
+    # create a handler for file logging, rotated every day
+    file_handler = _daily_file_handler(LOG_FILE_PATH)
     file_handler.setFormatter(file_formatter)
+    handlers = [stream, file_handler]
 
-    # construct the logger
-    logger = logging.getLogger(__name__)
+    if LOG_JSON_PATH:
+        json_handler = _daily_file_handler(pathlib.Path(LOG_JSON_PATH))
+        json_handler.setFormatter(JSONFormatter())
+        handlers.append(json_handler)
+
+    # the handlers run on the listener thread so logging never blocks the event loop on I/O
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # construct the logger, attached to the package logger so every module's logger uses it
+    logger = logging.getLogger("getwvkeysbot")
     logger.setLevel(LOG_LEVEL)
-    logger.addHandler(stream)
-    logger.addHandler(file_handler)
+    logger.addHandler(queue_handler)
     return logger
+
+
+def dropped_log_records() -> int:
+    return queue_handler.dropped if queue_handler is not None else 0
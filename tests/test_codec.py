@@ -0,0 +1,89 @@
+import os
+import unittest
+
+# the config reads these on import
+os.environ.setdefault("PREFIX", "!")
+os.environ.setdefault("BOT_TOKEN", "token")
+os.environ.setdefault("CLIENT_ID", "0")
+os.environ.setdefault("CLIENT_SECRET", "secret")
+os.environ.setdefault("REDIS_URI", "redis://localhost")
+
+from getwvkeysbot.codec import (  # noqa: E402
+    CODEC_JSON,
+    CODEC_MSGPACK,
+    FLAG_ZLIB,
+    FRAME_HEADER,
+    FRAME_MAGIC,
+    FRAME_VERSION,
+    U64_JSON_KEY,
+    PayloadCodec,
+    decode,
+    frame_codec,
+    msgpack,
+)
+
+# snowflakes, with the last one needing all 64 bits
+USER_IDS = [700000000000000000 + i * 7919 for i in range(500)] + [2**64 - 1]
+
+
+def bulk_payload(ids=USER_IDS) -> dict:
+    return {"op": 10, "d": {"user_ids": list(ids), "reason": "test"}, "reply_to": "bot:" + "0" * 32, "id": "0" * 32}
+
+
+class PayloadCodecTest(unittest.TestCase):
+    def assert_round_trip(self, codec: PayloadCodec, payload: dict) -> bytes:
+        data = codec.encode(payload)
+        self.assertEqual(decode(data), payload)
+        # replies go back in the format the request came in
+        self.assertEqual((frame_codec(data).version, frame_codec(data).codec), (codec.version, codec.codec))
+        return data
+
+    def test_legacy(self):
+        codec = PayloadCodec()
+        data = self.assert_round_trip(codec, bulk_payload())
+        self.assertNotEqual(data[:2], FRAME_MAGIC)
+        # plain JSON, readable by an API that predates the framed format
+        self.assertEqual(decode(data.decode()), bulk_payload())
+
+    def test_json_zlib_packed_ids(self):
+        codec = PayloadCodec(version=FRAME_VERSION, codec=CODEC_JSON, compress=True, pack_ids=True, compression_threshold=64)
+        payload = bulk_payload()
+        payload["d"]["note"] = "x" * 200
+        data = self.assert_round_trip(codec, payload)
+        _, version, codec_id, flags = FRAME_HEADER.unpack_from(data)
+        self.assertEqual((version, codec_id), (FRAME_VERSION, CODEC_JSON))
+        self.assertTrue(flags & FLAG_ZLIB)
+
+        uncompressed = PayloadCodec(version=FRAME_VERSION, codec=CODEC_JSON, pack_ids=True).encode(payload)
+        self.assertIn(U64_JSON_KEY.encode(), uncompressed)
+        self.assertLess(len(uncompressed), len(PayloadCodec().encode(payload)))
+
+    def test_ids_that_dont_fit_are_sent_as_is(self):
+        codec = PayloadCodec(version=FRAME_VERSION, codec=CODEC_JSON, pack_ids=True)
+        for ids in ([-1] * 100, [1] * 99 + ["1"], [1, 2, 3]):
+            with self.subTest(ids=ids[:3]):
+                data = self.assert_round_trip(codec, bulk_payload(ids))
+                self.assertNotIn(U64_JSON_KEY.encode(), data)
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        codec = PayloadCodec(version=FRAME_VERSION, codec=CODEC_MSGPACK, compress=True, pack_ids=True)
+        self.assert_round_trip(codec, bulk_payload())
+        self.assert_round_trip(codec, {"op": 1, "d": {"user_id": 1, "blob": b"\x00\xff"}, "id": "0" * 32})
+
+    def test_negotiate(self):
+        self.assertEqual(PayloadCodec.negotiate(None).version, 0)
+        self.assertEqual(PayloadCodec.negotiate({"version": 1, "codecs": ["cbor"]}).version, 0)
+        codec = PayloadCodec.negotiate({"version": 1, "codecs": ["json", "msgpack"], "compression": ["zlib"], "packed_ids": True})
+        self.assertEqual(codec.codec, CODEC_MSGPACK if msgpack is not None else CODEC_JSON)
+        self.assertTrue(codec.compress and codec.pack_ids)
+
+    def test_rejects_unknown_frames(self):
+        with self.assertRaises(ValueError):
+            decode(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION + 1, CODEC_JSON, 0) + b"{}")
+        with self.assertRaises(ValueError):
+            decode(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, 9, 0) + b"{}")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+# the config reads these on import
+os.environ.setdefault("PREFIX", "!")
+os.environ.setdefault("BOT_TOKEN", "token")
+os.environ.setdefault("CLIENT_ID", "0")
+os.environ.setdefault("CLIENT_SECRET", "secret")
+os.environ.setdefault("REDIS_URI", "redis://localhost")
+
+from getwvkeysbot import outbox as outbox_module  # noqa: E402
+from getwvkeysbot.outbox import Outbox  # noqa: E402
+from getwvkeysbot.redis import APIUnavailable, OPCode  # noqa: E402
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.audit = mock.Mock(urgent=mock.AsyncMock())
+        self.outbox = Outbox(self.audit, path=pathlib.Path(directory.name) / "outbox.sqlite3", rate=10000)
+        self.outbox._open()
+        self.addCleanup(self.outbox.db.close)
+
+        # every enable and disable goes through the coalescer, record them in the order they are sent
+        self.calls = []
+        self.failures = set()
+
+        def record(op):
+            async def send(user_id):
+                self.calls.append((op, user_id))
+                if (op, user_id) in self.failures:
+                    self.failures.discard((op, user_id))
+                    raise APIUnavailable("down")
+                return {"user_id": user_id}
+
+            return send
+
+        coalescer = mock.Mock(disable=record("disable"), enable=record("enable"))
+        patcher = mock.patch.object(outbox_module, "coalescer", coalescer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def done(self, entry_id: int) -> bool:
+        return self.outbox.db.execute("SELECT done_at IS NOT NULL FROM outbox WHERE id = ?", (entry_id,)).fetchone()[0] == 1
+
+    def test_user_entries_wait_for_earlier_ones(self):
+        disable = self.outbox.submit(OPCode.DISABLE_USER, {"user_id": 1}, audit="disabled 1")
+        enable = self.outbox.submit(OPCode.ENABLE_USER, {"user_id": 1}, audit="enabled 1")
+        other = self.outbox.submit(OPCode.DISABLE_USER, {"user_id": 2})
+        self.failures.add(("disable", 1))
+
+        asyncio.run(self.outbox._drain_batch())
+        # the disable is waiting for its retry, the enable behind it must not overtake it
+        self.assertEqual(self.calls, [("disable", 1), ("disable", 2)])
+        self.assertEqual((self.done(disable), self.done(enable), self.done(other)), (False, False, True))
+
+        self.outbox.db.execute("UPDATE outbox SET next_attempt_at = 0 WHERE id = ?", (disable,))
+        asyncio.run(self.outbox._drain_batch())
+        asyncio.run(self.outbox._drain_batch())
+        self.assertEqual(self.calls[2:], [("disable", 1), ("enable", 1)])
+        self.assertEqual(self.outbox.pending(), 0)
+        self.assertEqual(self.audit.log.call_args_list, [mock.call("disabled 1"), mock.call("enabled 1")])
+
+    def test_repeated_change_is_merged_into_the_pending_entry(self):
+        first = self.outbox.submit(OPCode.DISABLE_USER, {"user_id": 1})
+        # a ban fires both on_member_ban and on_member_remove
+        self.assertEqual(self.outbox.submit(OPCode.DISABLE_USER, {"user_id": 1}), first)
+        self.assertEqual(self.outbox.pending(), 1)
+
+        # only the newest pending entry counts, disable then enable then disable are three changes
+        enable = self.outbox.submit(OPCode.ENABLE_USER, {"user_id": 1})
+        disable = self.outbox.submit(OPCode.DISABLE_USER, {"user_id": 1})
+        self.assertEqual(len({first, enable, disable}), 3)
+        self.assertEqual(self.outbox.submit(OPCode.DISABLE_USER, {"user_id": 1}), disable)
+
+        for _ in range(3):
+            asyncio.run(self.outbox._drain_batch())
+        self.assertEqual(self.calls, [("disable", 1), ("enable", 1), ("disable", 1)])
+
+        # once sent, the same change is a new entry again
+        self.assertNotEqual(self.outbox.submit(OPCode.DISABLE_USER, {"user_id": 1}), disable)
+
+    def test_users_changed_since(self):
+        self.outbox.submit(OPCode.DISABLE_USER, {"user_id": 1})
+        self.outbox.db.execute("UPDATE outbox SET created_at = 0")
+        self.outbox.submit(OPCode.ENABLE_USER, {"user_id": 2})
+        self.assertEqual(self.outbox.users_changed_since(1), {2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import asyncio
+import base64
+import os
+import struct
+import unittest
+import uuid
+from unittest import mock
+
+# the config reads these on import
+os.environ.setdefault("PREFIX", "!")
+os.environ.setdefault("BOT_TOKEN", "token")
+os.environ.setdefault("CLIENT_ID", "0")
+os.environ.setdefault("CLIENT_SECRET", "secret")
+os.environ.setdefault("REDIS_URI", "redis://localhost")
+
+from getwvkeysbot.cogs import general  # noqa: E402
+from getwvkeysbot.pssh import WIDEVINE_SYSTEM_ID, normalize_kid, parse_pssh_boxes, parse_search_query  # noqa: E402
+
+KID_1 = bytes.fromhex("0123456789abcdef0123456789abcdef")
+KID_2 = bytes.fromhex("fedcba9876543210fedcba9876543210")
+OTHER_SYSTEM_ID = uuid.UUID("9a04f079-9840-4286-ab92-e65be0885f95")
+
+
+def widevine_data(*kids: bytes) -> bytes:
+    # WidevinePsshData with an algorithm, the key ids and a content id, like the ones players send
+    data = b"\x08\x01"
+    for kid in kids:
+        data += b"\x12\x10" + kid
+    return data + b"\x22\x04test"
+
+
+def pssh_box(system_id: uuid.UUID, data: bytes, kids=None) -> bytes:
+    body = system_id.bytes
+    if kids is not None:
+        body += struct.pack(">I", len(kids)) + b"".join(kids)
+    body += struct.pack(">I", len(data)) + data
+    version = 1 if kids is not None else 0
+    return struct.pack(">I4sI", 12 + len(body), b"pssh", version << 24) + body
+
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+class ParseSearchQueryTest(unittest.TestCase):
+    def test_kid_formats(self):
+        for query in ("0123456789ABCDEF0123456789ABCDEF", "01234567-89ab-cdef-0123-456789abcdef", "{01234567-89ab-cdef-0123-456789abcdef}", b64(KID_1)):
+            with self.subTest(query=query):
+                self.assertEqual(parse_search_query(query), ([KID_1.hex()], None))
+        self.assertIsNone(normalize_kid("0123456789abcdef"))
+
+    def test_v0_widevine_box(self):
+        box = pssh_box(WIDEVINE_SYSTEM_ID, widevine_data(KID_1, KID_2, KID_1))
+        self.assertEqual(parse_search_query(b64(box)), ([KID_1.hex(), KID_2.hex()], None))
+
+    def test_v1_box_header_kids(self):
+        box = pssh_box(OTHER_SYSTEM_ID, b"opaque", kids=[KID_1, KID_2])
+        (parsed,) = parse_pssh_boxes(box)
+        self.assertEqual((parsed.version, parsed.system_id, parsed.data), (1, OTHER_SYSTEM_ID, b"opaque"))
+        self.assertEqual(parse_search_query(b64(box)), ([KID_1.hex(), KID_2.hex()], None))
+
+    def test_concatenated_boxes(self):
+        data = pssh_box(OTHER_SYSTEM_ID, b"", kids=[KID_2]) + pssh_box(WIDEVINE_SYSTEM_ID, widevine_data(KID_1))
+        self.assertEqual(parse_search_query(b64(data)), ([KID_2.hex(), KID_1.hex()], None))
+
+    def test_bare_widevine_data(self):
+        data = widevine_data(KID_2)
+        # url-safe and unpadded, as copied from some players
+        query = base64.urlsafe_b64encode(data).decode().rstrip("=")
+        self.assertEqual(parse_search_query(query), ([KID_2.hex()], None))
+
+    def test_box_without_kids_is_sent_as_is(self):
+        box = pssh_box(WIDEVINE_SYSTEM_ID, b"\x22\x04test")
+        self.assertEqual(parse_search_query(b64(box)), ([], b64(box)))
+
+    def test_rejects_invalid_queries(self):
+        box = pssh_box(WIDEVINE_SYSTEM_ID, widevine_data(KID_1))
+        v1_box = pssh_box(OTHER_SYSTEM_ID, b"", kids=[KID_1])
+        queries = {
+            "truncated box": b64(box[:-5]),
+            "truncated header": b64(box[:20]),
+            "more v1 kids than the box holds": b64(v1_box[:28] + struct.pack(">I", 3) + v1_box[32:]),
+            "wrong box type": b64(box[:4] + b"moov" + box[8:]),
+            "unsupported version": b64(box[:8] + b"\x02" + box[9:]),
+            "garbage bytes": b64(b"\x07garbage" + b"\xff" * 40),
+            "not base64": "this is not a pssh!",
+            "empty": "",
+        }
+        for name, query in queries.items():
+            with self.subTest(name):
+                with self.assertRaises(ValueError):
+                    parse_search_query(query)
+
+    def test_search_rejects_without_asking_the_api(self):
+        ctx = mock.Mock()
+        ctx.reply = mock.AsyncMock()
+        with mock.patch.object(general, "fetch_page", mock.AsyncMock()) as fetch_page:
+            asyncio.run(general.General.key_search.callback(general.General(mock.Mock()), ctx, "not a pssh"))
+        fetch_page.assert_not_awaited()
+        ctx.reply.assert_awaited_once_with("Sorry, your query is not valid.")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import asyncio
+import contextlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# the config reads these on import
+os.environ.setdefault("PREFIX", "!")
+os.environ.setdefault("BOT_TOKEN", "token")
+os.environ.setdefault("CLIENT_ID", "0")
+os.environ.setdefault("CLIENT_SECRET", "secret")
+os.environ.setdefault("REDIS_URI", "redis://localhost")
+os.environ.setdefault("OUTBOX_PATH", os.path.join(tempfile.mkdtemp(), "outbox.sqlite3"))
+
+from benchmarks.fakeredis import FakeRedis  # noqa: E402
+from getwvkeysbot import main  # noqa: E402
+from getwvkeysbot.config import GUILD_ID  # noqa: E402
+
+
+class ReconcileLoopTest(unittest.TestCase):
+    def test_setup_hook_makes_the_loop_reconcile(self):
+        guild = mock.Mock(id=GUILD_ID)
+        reconcile = mock.AsyncMock(return_value=(0, 0))
+
+        async def run():
+            with contextlib.ExitStack() as stack:
+                # everything setup_hook starts except the cluster talks to redis or discord
+                stack.enter_context(mock.patch.object(main, "subscribe_invalidations", mock.AsyncMock()))
+                stack.enter_context(mock.patch.object(main.settings, "start", mock.AsyncMock()))
+                stack.enter_context(mock.patch.object(main.api, "start", mock.AsyncMock()))
+                stack.enter_context(mock.patch.object(main.outbox, "start"))
+                stack.enter_context(mock.patch.object(main.dm_queue, "start"))
+                stack.enter_context(mock.patch.object(main.bot, "load_extension", mock.AsyncMock()))
+                stack.enter_context(mock.patch.object(main.bot, "get_guild", return_value=guild))
+                stack.enter_context(mock.patch.object(main.cluster, "redis", FakeRedis()))
+                stack.enter_context(mock.patch.object(main.reconciler, "reconcile", reconcile))
+                await main.bot.setup_hook()
+                try:
+                    await main.reconcile_verified_members()
+                finally:
+                    if main.cluster._heartbeat is not None:
+                        main.cluster._heartbeat.cancel()
+                        main.cluster._heartbeat = None
+
+        asyncio.run(run())
+        reconcile.assert_awaited_once_with(guild, main.outbox)
+
+
+if __name__ == "__main__":
+    unittest.main()